@@ -0,0 +1,660 @@
+"""
+Offline benchmark and replay harness for the bot's event handlers.
+
+Runs on_message, the Music and Trivia cogs against a fake bot connection and fake voice clients, replays a synthetic
+(or recorded) message stream and reports throughput, p50/p99 latency and memory. Nothing touches the network.
+
+    python benchmark.py                              # every scenario, printed
+    python benchmark.py --save results.json          # also save the numbers
+    python benchmark.py --baseline results.json      # fail if a hot path got slower than the saved numbers
+    python benchmark.py --replay messages.jsonl      # replay recorded messages: {"server", "channel", "user", "content"}
+    python benchmark.py --pack 500000                # also load a synthetic pack of that many questions, peak RSS
+    python benchmark.py --micro shared_bank          # only run one micro-benchmark (see micro_benchmarks)
+"""
+import argparse
+import asyncio
+import config as c
+import gc
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+
+# the harness never saves caches, scores or metrics anywhere
+c.MUSIC_CACHE = None
+c.AUDIO_CACHE = None
+c.SHARED_TRANSCODE = False
+c.TRIVIA_DB = ':memory:'
+c.METRICS_PORT = None
+
+import main
+
+
+class FakeServer:
+    def __init__(self, server_id):
+        self.id = server_id
+
+
+class FakeChannel:
+    def __init__(self, channel_id, server):
+        self.id = channel_id
+        self.server = server
+        self.is_private = False
+
+    def __str__(self):
+        return self.id
+
+
+class FakeVoiceState:
+    def __init__(self, voice_channel):
+        self.voice_channel = voice_channel
+
+
+class FakeUser:
+    def __init__(self, user_id, voice_channel=None):
+        self.id = user_id
+        self.name = 'user' + user_id
+        self.bot = False
+        self.voice = FakeVoiceState(voice_channel)
+
+
+class FakeMessage:
+    def __init__(self, content, author, channel):
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.server = channel.server
+        self.mentions = []
+        self.raw_mentions = []
+
+
+class FakePlayer:
+    """
+    Stands in for discord.py's ffmpeg player: 'plays' for a short moment and then calls after.
+    """
+    def __init__(self, loop, after, length=0.05):
+        self.loop = loop
+        self.after = after
+        self.length = length
+        self.volume = 1.0
+        self.done = False
+
+    def start(self):
+        self.loop.call_later(self.length, self.stop)
+
+    def stop(self):
+        if not self.done:
+            self.done = True
+            if self.after is not None:
+                self.after()
+
+    def is_done(self):
+        return self.done
+
+    def pause(self):
+        pass
+
+    def resume(self):
+        pass
+
+
+class FakeVoice:
+    """
+    Stands in for discord.py's voice client. Frames handed to play_audio are counted and dropped.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.players = 0
+        self.frames = 0
+        self.encoder = types.SimpleNamespace(frame_size=3840, frame_length=20)
+        self._connected = threading.Event()
+        self._connected.set()
+
+    def play_audio(self, data, encode=True):
+        self.frames += 1
+
+    def create_ffmpeg_player(self, url, after=None, **kwargs):
+        self.players += 1
+        return FakePlayer(self.loop, after)
+
+    async def disconnect(self):
+        pass
+
+
+class Harness:
+    """
+    Builds the real bot from main.create_bot and replaces everything that would talk to Discord or YouTube.
+    """
+    songs = ['walk it talk it', 'never gonna give you up', 'bohemian rhapsody', 'mr brightside', 'africa toto',
+             'take on me', 'hey jude', 'smells like teen spirit', 'billie jean', 'wonderwall']
+
+    def __init__(self, servers, seed=0):
+        self.random = random.Random(seed)
+        self.loop = asyncio.get_event_loop()
+        main.TriviaSession.countdown = 0
+        self.bot = main.create_bot()
+        self.bot.send_message = self.send_message
+        self.bot.join_voice_channel = self.join_voice_channel
+        self.trivia = self.bot.get_cog('Trivia')
+        self.music = self.bot.get_cog('Music')
+        self.music.resolver.extractor = self.extract
+        self.sent = 0
+        self.servers = []
+        for number in range(servers):
+            server = FakeServer(str(number))
+            text = FakeChannel('{}-text'.format(number), server)
+            voice = FakeChannel('{}-voice'.format(number), server)
+            users = [FakeUser('{}-{}'.format(number, user), voice) for user in range(20)]
+            self.servers.append((server, text, users))
+
+    async def send_message(self, destination, content=None, *, tts=False, embed=None):
+        self.sent += 1
+
+    async def join_voice_channel(self, channel):
+        return FakeVoice(self.loop)
+
+    def extract(self, query):
+        time.sleep(0.001)
+        return {'id': str(abs(hash(query)) % 10 ** 11).zfill(11), 'url': 'http://localhost/' + query,
+                'webpage_url': 'http://localhost/' + query, 'title': query.title(), 'duration': 200}
+
+    async def start_trivia(self):
+        for server, channel, users in self.servers:
+            await self.bot.on_message(FakeMessage('.trivia', users[0], channel))
+        await asyncio.sleep(0)
+
+    def chat(self, channel, users):
+        words = ['lol', 'anyone here?', 'brb', 'what song is this', 'gg', 'nice', 'no way', 'ok', 'haha true']
+        return FakeMessage(self.random.choice(words), self.random.choice(users), channel)
+
+    def answer(self, channel, users):
+        session = self.trivia.channels.get(channel.id)
+        question = session.current_question if session is not None else None
+        if question is not None and self.random.random() < 0.2:
+            content = question.get_answer()
+        else:
+            content = self.random.choice(['paris', 'george washington', '1945', 'blue', 'einstein'])
+        return FakeMessage(content, self.random.choice(users), channel)
+
+    def typo(self, channel, users):
+        """
+        a near miss of the current answer (one letter swapped, dropped or changed), so the fuzzy matcher does its work.
+        """
+        session = self.trivia.channels.get(channel.id)
+        question = session.current_question if session is not None else None
+        content = question.get_answer() if question is not None else 'george washington'
+        position = self.random.randrange(len(content)) if content else 0
+        edit = self.random.choice(['swap', 'drop', 'change'])
+        if edit == 'swap' and position + 1 < len(content):
+            content = content[:position] + content[position + 1] + content[position] + content[position + 2:]
+        elif edit == 'drop':
+            content = content[:position] + content[position + 1:]
+        else:
+            content = content[:position] + self.random.choice('aeiouxyz') + content[position + 1:]
+        return FakeMessage(content, self.random.choice(users), channel)
+
+    def play(self, channel, users):
+        return FakeMessage('.play ' + self.random.choice(self.songs), self.random.choice(users), channel)
+
+    def queue(self, channel, users):
+        return FakeMessage('.queue', self.random.choice(users), channel)
+
+    def synthetic(self, count, mix):
+        """
+        generates a message stream spread over every server.
+        :param count: number of messages
+        :param mix: dict of message kind -> weight (chat, answer, typo, play, queue)
+        :return: generator of (kind, message factory)
+        """
+        kinds = list(mix)
+        weights = [mix[kind] for kind in kinds]
+        for _ in range(count):
+            kind = self.random.choices(kinds, weights)[0]
+            server, channel, users = self.random.choice(self.servers)
+            yield kind, getattr(self, kind), channel, users
+
+    def recorded(self, path):
+        with open(path, encoding='utf-8') as records:
+            for line in records:
+                record = json.loads(line)
+                server = FakeServer(str(record['server']))
+                channel = FakeChannel(str(record['channel']), server)
+                user = FakeUser(str(record['user']), FakeChannel(str(record['channel']) + '-voice', server))
+                message = FakeMessage(record['content'], user, channel)
+                yield 'replay', lambda channel, users, message=message: message, channel, [user]
+
+    async def run(self, stream):
+        """
+        sends every message of the stream through on_message, one after another, timing each.
+        :return: dict of kind -> list of latencies in seconds
+        """
+        latencies = {}
+        for kind, factory, channel, users in stream:
+            message = factory(channel, users)
+            started = time.perf_counter()
+            await self.bot.on_message(message)
+            latencies.setdefault(kind, []).append(time.perf_counter() - started)
+            await asyncio.sleep(0)
+        return latencies
+
+    async def close(self):
+        for status in self.music.voice_status.values():
+            status.audio_player.cancel()
+        self.trivia.scheduler.stop()
+        await asyncio.sleep(0.5)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(latencies, elapsed):
+    everything = [latency for kind in latencies.values() for latency in kind]
+    summary = {
+        'messages': len(everything),
+        'throughput': len(everything) / elapsed,
+        'p50_ms': percentile(everything, 0.5) * 1000,
+        'p99_ms': percentile(everything, 0.99) * 1000,
+    }
+    for kind, values in sorted(latencies.items()):
+        summary[kind] = {'messages': len(values), 'p50_ms': percentile(values, 0.5) * 1000,
+                         'p99_ms': percentile(values, 0.99) * 1000}
+    return summary
+
+
+scenarios = {
+    'chat': {'chat': 1},
+    'trivia': {'chat': 3, 'answer': 2},
+    'fuzzy': {'chat': 2, 'answer': 1, 'typo': 2},
+    'play': {'play': 3, 'queue': 1},
+    'mixed': {'chat': 10, 'answer': 4, 'play': 1, 'queue': 1},
+}
+
+
+def run_scenario(name, servers, count, replay=None):
+    gc.collect()
+    tracemalloc.start()
+    harness = Harness(servers)
+    loop = harness.loop
+    loop.run_until_complete(harness.start_trivia())
+    stream = harness.recorded(replay) if replay else harness.synthetic(count, scenarios[name])
+    started = time.perf_counter()
+    latencies = loop.run_until_complete(harness.run(stream))
+    elapsed = time.perf_counter() - started
+    loop.run_until_complete(harness.close())
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    summary = summarize(latencies, elapsed)
+    summary['peak_memory_mb'] = peak / 1024 ** 2
+    summary['messages_sent'] = harness.sent
+    return summary
+
+
+def timed(function, calls):
+    """
+    calls function(*args) for every args in calls, timing each call.
+    :return: summary dict, see summarize
+    """
+    latencies = []
+    started = time.perf_counter()
+    for args in calls:
+        called = time.perf_counter()
+        function(*args)
+        latencies.append(time.perf_counter() - called)
+    return summarize({'call': latencies}, time.perf_counter() - started)
+
+
+def bench_shared_bank(servers, count):
+    """
+    messages/s through on_message with the shared question bank, against on_message re-parsing the bank twice per
+    message (it used to build Trivia(bot) twice for every message).
+    """
+    harness = Harness(servers)
+    loop = harness.loop
+    on_message = harness.bot.on_message
+    messages = list(harness.synthetic(count, scenarios['chat']))
+    started = time.perf_counter()
+    after = loop.run_until_complete(harness.run(messages))
+    summary = summarize(after, time.perf_counter() - started)
+
+    async def reparsing_on_message(message):
+        main.QuestionBank(harness.trivia.bank.directory)
+        main.QuestionBank(harness.trivia.bank.directory)
+        await on_message(message)
+
+    harness.bot.on_message = reparsing_on_message
+    before = messages[:max(1, count // 1000)]
+    started = time.perf_counter()
+    loop.run_until_complete(harness.run(before))
+    summary['before_throughput'] = len(before) / (time.perf_counter() - started)
+    summary['speedup'] = summary['throughput'] / summary['before_throughput']
+    harness.bot.on_message = on_message
+    loop.run_until_complete(harness.close())
+    return summary
+
+
+def bench_startup(servers, count, loads=20):
+    """
+    question bank startup: a cold parse of every question file (writing the compiled cache) against loads from the
+    warm cache.
+    """
+    directory = main.QuestionBank.shared().directory
+    with tempfile.TemporaryDirectory() as cache_directory:
+        cache_path = os.path.join(cache_directory, 'questions.cache')
+        started = time.perf_counter()
+        main.QuestionBank(directory, cache_path=cache_path)
+        cold = time.perf_counter() - started
+        summary = timed(main.QuestionBank, [(directory, cache_path)] * loads)
+    summary['cold_ms'] = cold * 1000
+    summary['speedup'] = cold * 1000 / summary['p50_ms']
+    return summary
+
+
+def bench_guilds(servers, count):
+    """
+    load test for concurrent games: every server has a game running and all of them answer at once, round after round.
+    reports the latency of each answer (wrong or right) under that load.
+    """
+    harness = Harness(servers)
+    loop = harness.loop
+    loop.run_until_complete(harness.start_trivia())
+    latencies = []
+
+    async def answer(message):
+        started = time.perf_counter()
+        await harness.bot.on_message(message)
+        latencies.append(time.perf_counter() - started)
+
+    async def rounds():
+        for _ in range(max(1, count // servers)):
+            await asyncio.gather(*(answer(harness.answer(channel, users)) for server, channel, users in harness.servers))
+
+    started = time.perf_counter()
+    loop.run_until_complete(rounds())
+    summary = summarize({'answer': latencies}, time.perf_counter() - started)
+    summary['games'] = float(sum(1 for session in harness.trivia.channels.values() if session.is_running))
+    loop.run_until_complete(harness.close())
+    return summary
+
+
+def bench_matcher(servers, count, live=500, seed=0):
+    """
+    answer matching alone: chat, near misses and right answers checked against live questions (plain and Regexp ones),
+    normalizing each message once like Trivia.answer_question does.
+    """
+    rng = random.Random(seed)
+    pool = main.QuestionPool(main.QuestionBank.shared().questions)
+    questions = [pool.draw() for _ in range(live)]
+    for question in questions:
+        question.compile()
+    words = ['lol', 'anyone here?', 'brb', 'gg', 'no idea', 'paris', 'george washington', '1945', 'einstein']
+    calls = []
+    for _ in range(count):
+        question = rng.choice(questions)
+        kind = rng.random()
+        if kind < 0.2:
+            content = question.get_answer()
+        elif kind < 0.4:
+            content = question.get_answer()[:-1] + 'x'
+        else:
+            content = rng.choice(words)
+        calls.append((question, content))
+
+    def check(question, content):
+        guess = question.prepare(content)
+        return question.might_match(guess) and question.answer_check(guess)
+
+    return timed(check, calls)
+
+
+def bench_playlist(servers, count, size=10000, seed=0):
+    """
+    playlist operations on a 10k-song queue (built with max_size raised, the default caps a queue at 1000): paging,
+    removing and re-adding, moving, taking the next song and shuffling. the queue is kept at size throughout.
+    """
+    rng = random.Random(seed)
+    loop = asyncio.get_event_loop()
+    channel = FakeChannel('playlist', FakeServer('playlist'))
+    users = [FakeUser(str(user)) for user in range(100)]
+    playlist = main.Playlist(max_size=size, per_user=size)
+    entries = [main.JoinVoice(FakeMessage('.play song', rng.choice(users), channel), 'song {}'.format(number))
+               for number in range(size)]
+    latencies = {'put': []}
+    for entry in entries:
+        called = time.perf_counter()
+        playlist.put(entry)
+        latencies['put'].append(time.perf_counter() - called)
+
+    def page():
+        playlist.page(rng.randrange(len(playlist) - 10), 10)
+
+    def remove():
+        entry = playlist[rng.randrange(len(playlist))]
+        playlist.remove(entry)
+        playlist.put(entry)
+
+    def move():
+        playlist.move(rng.randrange(len(playlist)), rng.randrange(len(playlist)))
+
+    def get():
+        playlist.put(loop.run_until_complete(playlist.get()))
+
+    operations = {'page': page, 'remove': remove, 'move': move, 'get': get, 'shuffle': playlist.shuffle}
+    started = time.perf_counter()
+    for _ in range(count):
+        name = rng.choice(['page', 'page', 'remove', 'move', 'get']) if rng.random() > 0.002 else 'shuffle'
+        called = time.perf_counter()
+        operations[name]()
+        latencies.setdefault(name, []).append(time.perf_counter() - called)
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def bench_metrics(servers, count, batch=1000):
+    """
+    instrumentation overhead: the cost of one Metrics.observe and one Metrics.inc (timed over batches of calls, so the
+    timer itself doesn't dominate) and of rendering a scrape.
+    """
+    recorder = main.Metrics()
+    values = [random.Random(0).random() * 0.01 for _ in range(batch)]
+    batches = []
+    started = time.perf_counter()
+    for _ in range(max(1, count // batch)):
+        called = time.perf_counter()
+        for value in values:
+            recorder.observe('on_message_dispatch_seconds', value)
+        batches.append((time.perf_counter() - called) / batch)
+    summary = summarize({'observe': batches}, (time.perf_counter() - started) / batch)
+    called = time.perf_counter()
+    for _ in range(count):
+        recorder.inc('messages_total')
+    summary['inc_us'] = (time.perf_counter() - called) / count * 10 ** 6
+    summary['observe_us'] = summary['p50_ms'] * 1000
+    for server in range(servers):
+        recorder.observe('command_seconds', 0.001, ('command', 'play'), ('server', str(server)))
+    called = time.perf_counter()
+    recorder.render()
+    summary['render_ms'] = (time.perf_counter() - called) * 1000
+    return summary
+
+
+def bench_opus_cache(servers, count, frames=15000, seed=0):
+    """
+    the audio cache hit path: a synthetic cached track (length-prefixed Opus frames, five minutes' worth) played by
+    OpusCachePlayer.play_frames from a local file, with no pacing delay and a voice client that drops the frames.
+    """
+    rng = random.Random(seed)
+    voice = FakeVoice(asyncio.get_event_loop())
+    latencies = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'track.opus')
+        with open(path, 'wb') as cache_file:
+            for _ in range(frames):
+                frame = bytes(rng.randrange(256) for _ in range(rng.randint(100, 160)))
+                cache_file.write(len(frame).to_bytes(2, 'little'))
+                cache_file.write(frame)
+        for _ in range(max(1, count // frames)):
+            player = main.OpusCachePlayer(path, voice)
+            player.delay = 0
+            started = time.perf_counter()
+            player._do_run()
+            latencies.append((time.perf_counter() - started) / frames)
+    summary = summarize({'frame': latencies}, sum(latencies))
+    summary['frames_sent'] = float(voice.frames)
+    return summary
+
+
+micro_benchmarks = {
+    'guilds': bench_guilds,
+    'matcher': bench_matcher,
+    'metrics': bench_metrics,
+    'opus_cache': bench_opus_cache,
+    'playlist': bench_playlist,
+    'shared_bank': bench_shared_bank,
+    'startup': bench_startup,
+}
+
+
+def run_micro(name, servers, count):
+    gc.collect()
+    return micro_benchmarks[name](servers, count)
+
+
+def write_pack(path, count, seed=0):
+    """
+    writes a synthetic MoxQuizz question file.
+    :param path: file to write
+    :param count: number of questions
+    """
+    rng = random.Random(seed)
+    categories = ['Geography', 'History', 'Music', 'Science', 'Sports', 'Movies', 'Literature', 'Food']
+    levels = ['easy', 'normal', 'hard']
+    with open(path, 'w', encoding='utf-8') as pack:
+        for number in range(count):
+            pack.write('Category: {}\nQuestion: Which answer belongs to synthetic question number {}?\n'
+                       'Answer: answer {}\nLevel: {}\nAuthor: benchmark\n\n'.format(
+                           rng.choice(categories), number, number, rng.choice(levels)))
+
+
+def measure_pack(directory, draws, results):
+    """
+    loads the question bank from directory and draws from it, in a fresh process so peak RSS is the bank's alone.
+    """
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    bank = main.QuestionBank(directory)
+    load_seconds = time.perf_counter() - started
+    pool = main.QuestionPool(bank.questions)
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(draws):
+        drawn = time.perf_counter()
+        pool.draw()
+        latencies.append(time.perf_counter() - drawn)
+    summary = summarize({'draw': latencies}, time.perf_counter() - started)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    summary['questions'] = len(bank.questions)
+    summary['load_seconds'] = load_seconds
+    summary['peak_rss_mb'] = peak / 1024
+    summary['bytes_per_question'] = (peak - before) * 1024 / max(1, len(bank.questions))
+    results.put(summary)
+
+
+def run_pack(count, draws=10000):
+    """
+    benchmarks loading a large synthetic question pack: load time, peak RSS, memory per question and draw latency.
+    :param count: number of questions in the pack
+    :return: dict
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        write_pack(os.path.join(directory, 'questions.synthetic.en'), count)
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        process = context.Process(target=measure_pack, args=(directory, draws, results))
+        process.start()
+        summary = results.get()
+        process.join()
+    return summary
+
+
+def compare(results, baseline, tolerance):
+    """
+    lists every result that got more than (1 + tolerance) times worse: throughput divided by it, or p99 latency and
+    peak RSS multiplied by it. p99 is only compared for the message scenarios, the micro-benchmarks' p99s are a few
+    microseconds and too noisy to gate on.
+    :return: list of strings
+    """
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        if result['throughput'] < old['throughput'] / (1 + tolerance):
+            regressions.append('{}: throughput {:.0f}/s -> {:.0f}/s'.format(name, old['throughput'],
+                                                                          result['throughput']))
+        if name in scenarios and result['p99_ms'] > old['p99_ms'] * (1 + tolerance):
+            regressions.append('{}: p99 {:.3f}ms -> {:.3f}ms'.format(name, old['p99_ms'], result['p99_ms']))
+        if 'peak_rss_mb' in old and result['peak_rss_mb'] > old['peak_rss_mb'] * (1 + tolerance):
+            regressions.append('{}: peak RSS {:.1f}MB -> {:.1f}MB'.format(name, old['peak_rss_mb'],
+                                                                         result['peak_rss_mb']))
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Offline benchmark for MewSick event handlers.')
+    parser.add_argument('--scenario', choices=sorted(scenarios), action='append')
+    parser.add_argument('--micro', choices=sorted(micro_benchmarks), action='append')
+    parser.add_argument('--servers', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--replay', help='jsonl file of recorded messages to replay instead')
+    parser.add_argument('--save', help='write the results to this json file')
+    parser.add_argument('--baseline', help='json file from --save to compare against')
+    parser.add_argument('--pack', type=int, default=0, help='also benchmark loading a synthetic pack this large')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    if args.replay:
+        names, micros = ['replay'], []
+    elif args.scenario or args.micro:
+        names, micros = args.scenario or [], args.micro or []
+    else:
+        names, micros = sorted(scenarios), sorted(micro_benchmarks)
+    results = {}
+    for name in names:
+        results[name] = run_scenario(name, args.servers, args.messages, args.replay)
+        result = results[name]
+        print('{:12} {:9.0f} msg/s  p50 {:7.3f}ms  p99 {:7.3f}ms  peak {:6.1f}MB'.format(
+            name, result['throughput'], result['p50_ms'], result['p99_ms'], result['peak_memory_mb']))
+    for name in micros:
+        results[name] = result = run_micro(name, args.servers, args.messages)
+        extra = '  '.join('{} {:.4g}'.format(key, value) for key, value in sorted(result.items())
+                          if isinstance(value, float) and key not in ('throughput', 'p50_ms', 'p99_ms'))
+        print('{:12} {:9.0f} op/s   p50 {:7.3f}ms  p99 {:7.3f}ms  {}'.format(
+            name, result['throughput'], result['p50_ms'], result['p99_ms'], extra))
+    if args.pack:
+        results['pack'] = result = run_pack(args.pack)
+        print('{:12} {:9.0f} draw/s p50 {:7.3f}ms  p99 {:7.3f}ms  peak RSS {:6.1f}MB  {:.0f} bytes/question  '
+              'load {:.2f}s'.format('pack', result['throughput'], result['p50_ms'], result['p99_ms'],
+                                    result['peak_rss_mb'], result['bytes_per_question'], result['load_seconds']))
+
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            json.dump(results, results_file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -1 +1,26 @@
 TOKEN = ""
+
+# compiled trivia question cache, rebuilt automatically when a question file changes
+TRIVIA_CACHE = 'trivia/.questions.cache'
+
+# youtube song info cache, saved between restarts. set to None to keep it in memory only
+MUSIC_CACHE = 'music.cache'
+
+# folder for the opt-in Opus audio cache (None turns it off) and its size limit in bytes
+AUDIO_CACHE = None
+AUDIO_CACHE_SIZE = 2 * 1024 ** 3
+
+# servers starting the same track at about the same time share one ffmpeg transcode
+SHARED_TRANSCODE = True
+
+# sqlite database for trivia scores and leaderboards (None keeps scores for the current game only)
+TRIVIA_DB = 'trivia.db'
+
+# number of shard processes to run (1 runs the bot in this process)
+SHARD_COUNT = 1
+
+# port for the local Prometheus metrics endpoint (None turns it off). shards use METRICS_PORT + shard id
+METRICS_PORT = None
+
+# most typos accepted in a trivia answer (one per five letters, never for answers with numbers)
+TRIVIA_MAX_TYPOS = 2
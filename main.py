@@ -1,43 +1,952 @@
 import discord
 from discord.ext import commands
+from discord.voice_client import StreamPlayer
+from array import array
 import asyncio
+import audioop
+import bisect
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import config as c
+import heapq
+import itertools
+import mmap
+import multiprocessing
 import os
+import pickle
 import random
 import re
+import signal
+import sqlite3
+import subprocess
+import threading
+import time
+import unicodedata
+import youtube_dl
 
 if not discord.opus.is_loaded():
     discord.opus.load_opus('opus')
 
 
+class Metrics:
+    """
+    Low-overhead counters and latency histograms for the bot's hot paths, rendered in the Prometheus text format.
+    Histograms use fixed buckets, so recording a value is a bisect and two additions. Player threads record frame
+    timings too, hence the lock.
+    """
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, prefix='mewsick'):
+        self.prefix = prefix
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, value, *labels):
+        """
+        records a value (usually seconds) in a histogram.
+        :param name: metric name
+        :param value: number
+        :param labels: optional (label, value) pairs
+        :return: None
+        """
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+            histogram[1] += value
+
+    def inc(self, name, *labels):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def add_gauge(self, name, callback, kind='gauge'):
+        """
+        registers a gauge read when metrics are rendered.
+        :param callback: returns a dict of label pairs tuple -> value
+        :param kind: Prometheus type of the values, 'counter' for totals kept elsewhere
+        :return: None
+        """
+        self.gauges[name] = (callback, kind)
+
+    def format_labels(self, labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(label, value) for label, value in labels) + '}'
+
+    def render(self):
+        """
+        renders every metric in the Prometheus text exposition format.
+        :return: string
+        """
+        lines = []
+        with self.lock:
+            histograms = sorted((key, list(counts), total) for key, (counts, total) in self.histograms.items())
+            counters = sorted(self.counters.items())
+        typed = set()
+        for (name, labels), counts, total in histograms:
+            name = '{}_{}'.format(self.prefix, name)
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} histogram'.format(name))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, self.format_labels(labels, (('le', bound),)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, self.format_labels(labels), total))
+            lines.append('{}_count{} {}'.format(name, self.format_labels(labels), cumulative))
+        for (name, labels), value in counters:
+            name = '{}_{}'.format(self.prefix, name)
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} counter'.format(name))
+            lines.append('{}{} {}'.format(name, self.format_labels(labels), value))
+        for name, (callback, kind) in sorted(self.gauges.items()):
+            lines.append('# TYPE {}_{} {}'.format(self.prefix, name, kind))
+            for labels, value in callback().items():
+                lines.append('{}_{}{} {}'.format(self.prefix, name, self.format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    async def handle(self, reader, writer):
+        await reader.readline()
+        body = self.render().encode()
+        writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: ' +
+                     str(len(body)).encode() + b'\r\n\r\n' + body)
+        await writer.drain()
+        writer.close()
+
+    async def serve(self, host, port):
+        """
+        serves the metrics over http (any path) for Prometheus to scrape.
+        :return: asyncio server
+        """
+        return await asyncio.start_server(self.handle, host, port)
+
+
+metrics = Metrics()
+
+
 class JoinVoice:
-    def __init__(self, message, player):
+    """
+    A song request waiting in the queue. Only holds the query until the TrackResolver fills in its youtube_dl info,
+    the ffmpeg player is created right before the song plays.
+    """
+    def __init__(self, message, query):
         self.channel = message.channel
         self.author = message.author
-        self.player = player
+        self.query = query
+        self.info = None
+        self.resolved_at = None
+        self.resolving = None
+        self.player = None
 
     def __str__(self):
         """
         Replaces current str function with formatting for title of video and length.
         :return: string
         """
-        request_format = "`{0.title}"
-        duration = self.player.duration
+        if self.info is None:
+            return '`{}`'.format(self.query)
+        request_format = '`{}'.format(self.info.get('title', self.query))
+        duration = self.info.get('duration')
         if duration:
-            request_format = request_format + " [{0[0]}m {0[1]}s]`".format(divmod(duration, 60))
-        return request_format.format(self.player)
+            request_format += ' [{0[0]}m {0[1]}s]'.format(divmod(duration, 60))
+        return request_format + '`'
+
+
+class MetadataCache:
+    """
+    LRU cache of youtube_dl info shared by every server, so popular songs aren't looked up again for each request.
+    Entries are keyed by normalized search term and by video id, expire after ttl seconds and can be saved to disk.
+    """
+    video_id = re.compile(r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|embed/|shorts/)|youtu\.be/)([\w-]{11})')
+    fields = ('id', 'url', 'webpage_url', 'title', 'duration', 'uploader', 'is_live', 'ext', 'format_id', 'abr')
+
+    def __init__(self, max_size=1000, ttl=3600, path=None, save_every=50):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.save_every = save_every
+        self.entries = OrderedDict()
+        self.unsaved = 0
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    @classmethod
+    def key(cls, query):
+        """
+        turns a url or search term into a cache key. youtube urls are keyed by their video id.
+        :param query: url or search term
+        :return: string
+        """
+        match = cls.video_id.search(query)
+        if match:
+            return 'id:' + match.group(1)
+        return 'search:' + ' '.join(query.lower().split())
+
+    def get(self, key, max_age=None):
+        """
+        looks up a key, counting hits and misses.
+        :param key: from MetadataCache.key
+        :param max_age: optional limit (in seconds) stricter than the ttl
+        :return: (info, age in seconds) or None
+        """
+        item = self.entries.get(key)
+        if item is not None:
+            age = time.time() - item[0]
+            if age <= self.ttl and (max_age is None or age <= max_age):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return item[1], age
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, info):
+        """
+        stores the parts of a youtube_dl info dict needed for playback under key and under its video id.
+        :param key: from MetadataCache.key
+        :param info: youtube_dl info dict
+        :return: the trimmed info dict
+        """
+        info = {field: info[field] for field in self.fields if field in info}
+        item = (time.time(), info)
+        keys = [key]
+        if info.get('id'):
+            keys.append('id:' + info['id'])
+        for name in keys:
+            self.entries[name] = item
+            self.entries.move_to_end(name)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        self.unsaved += 1
+        if self.unsaved >= self.save_every:
+            self.save()
+        return info
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'rb') as cache_file:
+                entries = pickle.load(cache_file)
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+            return
+        now = time.time()
+        for key, item in entries:
+            if now - item[0] <= self.ttl:
+                self.entries[key] = item
+
+    def save(self):
+        """
+        writes the cache to disk (if a path is set) atomically.
+        :return: None
+        """
+        self.unsaved = 0
+        if not self.path:
+            return
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as cache_file:
+                pickle.dump(list(self.entries.items()), cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.path)
+        except OSError:
+            pass
+
+
+class TrackResolver:
+    """
+    Runs youtube_dl extraction for song requests in a small, bounded thread pool so commands never wait on it.
+    Stream urls expire, so an entry resolved more than refresh_after seconds ago is resolved again before it plays.
+    Lookups go through a MetadataCache, and concurrent requests for the same song share one extraction.
+    """
+    options = {
+        'format': 'webm[abr>0]/bestaudio/best',
+        'default_search': 'auto',
+        'quiet': True
+    }
+
+    def __init__(self, loop, workers=2, refresh_after=1800, extractor=None, cache=None):
+        self.loop = loop
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.refresh_after = refresh_after
+        self.extractor = extractor or self.extract
+        self.cache = cache if cache is not None else MetadataCache()
+        self.pending = {}
+
+    def extract(self, query):
+        """
+        runs youtube_dl on a url or search term. blocking, only call from the executor.
+        :param query: url or search term
+        :return: info dict of the video
+        """
+        info = youtube_dl.YoutubeDL(self.options).extract_info(query, download=False)
+        if 'entries' in info:
+            info = info['entries'][0]
+        return info
+
+    def is_stale(self, entry):
+        return entry.resolved_at is not None and self.loop.time() - entry.resolved_at > self.refresh_after
+
+    def prefetch(self, entry):
+        """
+        starts resolving the entry if it isn't resolved yet or its stream url is about to expire.
+        :param entry: JoinVoice
+        :return: future of the entry's info dict
+        """
+        if entry.resolving is None or self.is_stale(entry):
+            entry.resolving = asyncio.ensure_future(self.resolve(entry), loop=self.loop)
+        return entry.resolving
+
+    async def resolve(self, entry):
+        key = self.cache.key(entry.query)
+        cached = self.cache.get(key, max_age=self.refresh_after)
+        if cached is not None:
+            entry.info, age = cached
+        else:
+            fetch = self.pending.get(key)
+            if fetch is None:
+                fetch = asyncio.ensure_future(self.fetch(key, entry.query), loop=self.loop)
+                self.pending[key] = fetch
+            entry.info = await asyncio.shield(fetch)
+            age = 0
+        entry.resolved_at = self.loop.time() - age
+        return entry.info
+
+    async def fetch(self, key, query):
+        try:
+            started = time.perf_counter()
+            info = await self.loop.run_in_executor(self.executor, self.extractor, query)
+            metrics.observe('extractor_resolve_seconds', time.perf_counter() - started)
+            return self.cache.put(key, info)
+        finally:
+            del self.pending[key]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+        self.cache.save()
+
+
+class AudioCache:
+    """
+    Opt-in disk cache of tracks as pre-encoded Opus frames, keyed by video id. Cached tracks are played by
+    OpusCachePlayer without ffmpeg or encoding. Misses played through a TrackBroadcast are written from its frames
+    (see open_writer), other misses are transcoded in the background (one at a time). The least recently played files
+    are deleted once the cache grows past max_bytes.
+    Each file is a sequence of frames, every frame prefixed by its length as a 2 byte little-endian integer.
+    """
+    def __init__(self, directory, max_bytes, loop, max_duration=1200):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.loop = loop
+        self.max_duration = max_duration
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.filling = set()
+        self.files = OrderedDict()
+        self.size = 0
+
+        os.makedirs(directory, exist_ok=True)
+        paths = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.opus')]
+        for path in sorted(paths, key=os.path.getmtime):
+            video_id = os.path.basename(path)[:-len('.opus')]
+            self.files[video_id] = os.path.getsize(path)
+            self.size += self.files[video_id]
+
+    def path(self, video_id):
+        return os.path.join(self.directory, video_id + '.opus')
+
+    def get(self, video_id):
+        """
+        looks up a track, marking it as recently played.
+        :param video_id: youtube video id
+        :return: path of the cached file or None
+        """
+        if video_id not in self.files:
+            return None
+        self.files.move_to_end(video_id)
+        path = self.path(video_id)
+        try:
+            os.utime(path)
+        except OSError:
+            self.size -= self.files.pop(video_id)
+            return None
+        return path
+
+    @staticmethod
+    def open_pcm_stream(url):
+        """
+        starts ffmpeg decoding url to 48kHz stereo 16-bit PCM on its stdout.
+        :param url: stream url
+        :return: subprocess.Popen
+        """
+        args = ['ffmpeg', '-loglevel', 'warning', '-i', url, '-f', 's16le', '-ar', '48000', '-ac', '2', 'pipe:1']
+        return subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+
+    def can_fill(self, info):
+        """
+        whether a track should be cached: not cached or being cached already, not live and not too long.
+        :param info: youtube_dl info dict
+        :return: Boolean
+        """
+        video_id = info.get('id')
+        duration = info.get('duration')
+        if not video_id or video_id in self.files or video_id in self.filling:
+            return False
+        return not info.get('is_live') and bool(duration) and duration <= self.max_duration
+
+    def fill(self, info):
+        """
+        transcodes a track into the cache in the background. live streams and long tracks are skipped.
+        :param info: youtube_dl info dict
+        :return: None
+        """
+        if not self.can_fill(info):
+            return
+        video_id = info['id']
+        self.filling.add(video_id)
+        future = self.loop.run_in_executor(self.executor, self.transcode, video_id, info['url'])
+        future.add_done_callback(lambda done: self.store(video_id, done))
+
+    def transcode(self, video_id, url):
+        """
+        decodes the stream with ffmpeg and writes it as Opus frames. blocking, only call from the executor.
+        :return: size of the cached file
+        """
+        encoder = discord.opus.Encoder(48000, 2)
+        temp_path = self.path(video_id) + '.part'
+        process = self.open_pcm_stream(url)
+        try:
+            with open(temp_path, 'wb') as cache_file:
+                while True:
+                    pcm = process.stdout.read(encoder.frame_size)
+                    if not pcm:
+                        break
+                    pcm = pcm.ljust(encoder.frame_size, b'\0')
+                    frame = encoder.encode(pcm, encoder.samples_per_frame)
+                    cache_file.write(len(frame).to_bytes(2, 'little'))
+                    cache_file.write(frame)
+            if process.wait() != 0:
+                raise RuntimeError('ffmpeg exited with code {}'.format(process.returncode))
+            os.replace(temp_path, self.path(video_id))
+        except BaseException:
+            process.kill()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return os.path.getsize(self.path(video_id))
+
+    def open_writer(self, info):
+        """
+        starts caching a track whose frames are already being encoded elsewhere (a TrackBroadcast), so it is not
+        transcoded a second time. call close_writer when the track ends.
+        :param info: youtube_dl info dict
+        :return: file to write the length-prefixed frames to, or None if the track shouldn't be cached
+        """
+        if not self.can_fill(info):
+            return None
+        try:
+            cache_file = open(self.path(info['id']) + '.part', 'wb')
+        except OSError:
+            return None
+        self.filling.add(info['id'])
+        return cache_file
+
+    def close_writer(self, video_id, cache_file, complete):
+        """
+        finishes a file from open_writer, keeping it only if the whole track was written. safe to call from any thread.
+        :return: None
+        """
+        size = None
+        try:
+            cache_file.close()
+            if complete:
+                os.replace(cache_file.name, self.path(video_id))
+                size = os.path.getsize(self.path(video_id))
+            else:
+                os.remove(cache_file.name)
+        except OSError:
+            pass
+        self.loop.call_soon_threadsafe(self.add, video_id, size)
+
+    def store(self, video_id, done):
+        if done.cancelled() or done.exception() is not None:
+            self.add(video_id, None)
+        else:
+            self.add(video_id, done.result())
+
+    def add(self, video_id, size):
+        """
+        records a finished file and evicts the least recently played ones past max_bytes.
+        :param size: size of the file, None if caching it failed
+        :return: None
+        """
+        self.filling.discard(video_id)
+        if size is None:
+            return
+        self.files[video_id] = size
+        self.size += size
+        while self.size > self.max_bytes and len(self.files) > 1:
+            oldest, size = self.files.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self.path(oldest))
+            except OSError:
+                pass
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+class OpusCachePlayer(StreamPlayer):
+    """
+    Plays a track cached by AudioCache. Frames are sliced out of a memory-mapped file and sent as they are, so
+    there is no ffmpeg process and no encoding. The frames are already encoded, so volume changes are not applied.
+    """
+    def __init__(self, path, voice, after=None):
+        super().__init__(None, voice.encoder, voice._connected, voice.play_audio, after)
+        self.path = path
+
+    def _do_run(self):
+        with open(self.path, 'rb') as cache_file:
+            with mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ) as frames:
+                self.play_frames(frames)
+
+    def play_frames(self, frames):
+        self.loops = 0
+        self._start = time.time()
+        position = 0
+        while not self._end.is_set():
+            if not self._resumed.is_set():
+                self._resumed.wait()
+                self._start = time.time()
+                self.loops = 0
+            if not self._connected.is_set():
+                self.stop()
+                break
+            if position + 2 > len(frames):
+                self.stop()
+                break
+            self.loops += 1
+            size = int.from_bytes(frames[position:position + 2], 'little')
+            lateness = time.time() - self._start - self.delay * (self.loops - 1)
+            metrics.observe('frame_send_lateness_seconds', max(0, lateness))
+            self.player(frames[position + 2:position + 2 + size], encode=False)
+            position += 2 + size
+            next_time = self._start + self.delay * self.loops
+            delay = max(0, self.delay + (next_time - time.time()))
+            time.sleep(delay)
+
+
+class TrackBroadcast:
+    """
+    Decodes and encodes one track once and hands the same frame buffers to every server playing it. Each
+    BroadcastPlayer keeps its own cursor into the shared frame lists, so frames are never copied per subscriber.
+    The producer stays at most max_ahead frames in front of the fastest subscriber, and frames every subscriber has
+    played are dropped once the join window is over (or the buffer passes max_buffer frames).
+    With cache_file (from AudioCache.open_writer) every encoded frame is also written to the audio cache.
+    """
+    def __init__(self, video_id, url, join_window=10, max_ahead=250, max_buffer=3000, cache=None, cache_file=None):
+        self.video_id = video_id
+        self.url = url
+        self.cache = cache
+        self.cache_file = cache_file
+        self.join_window = join_window
+        self.max_ahead = max_ahead
+        self.max_buffer = max_buffer
+        self.pcm = []
+        self.opus = []
+        self.offset = 0
+        self.finished = False
+        self.subscribers = set()
+        self.condition = threading.Condition()
+        self.started = time.time()
+        self.producer = threading.Thread(target=self.produce, daemon=True)
+
+    def can_join(self):
+        return not self.finished and self.offset == 0 and time.time() - self.started < self.join_window
+
+    def produce(self):
+        encoder = discord.opus.Encoder(48000, 2)
+        process = AudioCache.open_pcm_stream(self.url)
+        complete = False
+        try:
+            while True:
+                with self.condition:
+                    while self.subscribers and self.offset + len(self.opus) - self.leader() > self.max_ahead:
+                        self.condition.wait()
+                    if not self.subscribers:
+                        break
+                pcm = process.stdout.read(encoder.frame_size)
+                if not pcm:
+                    complete = process.wait() == 0
+                    break
+                pcm = pcm.ljust(encoder.frame_size, b'\0')
+                frame = encoder.encode(pcm, encoder.samples_per_frame)
+                self.write_cache(frame)
+                with self.condition:
+                    self.pcm.append(pcm)
+                    self.opus.append(frame)
+                    self.condition.notify_all()
+        finally:
+            process.kill()
+            if self.cache_file is not None:
+                self.cache.close_writer(self.video_id, self.cache_file, complete)
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+
+    def write_cache(self, frame):
+        if self.cache_file is None:
+            return
+        try:
+            self.cache_file.write(len(frame).to_bytes(2, 'little'))
+            self.cache_file.write(frame)
+        except OSError:
+            # caching is best effort, playback goes on without it
+            self.cache.close_writer(self.video_id, self.cache_file, False)
+            self.cache_file = None
+
+    def leader(self):
+        return max((player.cursor for player in self.subscribers), default=self.offset)
+
+    def frame(self, player):
+        """
+        waits for the frame at the player's cursor.
+        :param player: BroadcastPlayer
+        :return: (pcm, opus) buffers, or None at the end of the track
+        """
+        with self.condition:
+            if player.cursor < self.offset:
+                player.cursor = self.offset
+            while player.cursor >= self.offset + len(self.opus) and not self.finished:
+                self.condition.wait()
+            index = player.cursor - self.offset
+            if index >= len(self.opus):
+                return None
+            return self.pcm[index], self.opus[index]
+
+    def advance(self, player):
+        with self.condition:
+            player.cursor += 1
+            self.trim()
+            self.condition.notify_all()
+
+    def trim(self):
+        if time.time() - self.started < self.join_window and len(self.opus) < self.max_buffer:
+            return
+        keep = min((player.cursor for player in self.subscribers), default=self.offset + len(self.opus))
+        keep = max(keep, self.offset + len(self.opus) - self.max_buffer)
+        drop = keep - self.offset
+        if drop > 0:
+            del self.pcm[:drop]
+            del self.opus[:drop]
+            self.offset = keep
+
+    def subscribe(self, player):
+        with self.condition:
+            self.subscribers.add(player)
+
+    def unsubscribe(self, player):
+        with self.condition:
+            self.subscribers.discard(player)
+            self.condition.notify_all()
+
+
+class BroadcastPlayer(StreamPlayer):
+    """
+    Plays a track from a shared TrackBroadcast. Frames are sent pre-encoded unless the volume is changed, in which
+    case the shared PCM frame is scaled and encoded for this server only.
+    """
+    def __init__(self, broadcast, voice, after=None):
+        super().__init__(None, voice.encoder, voice._connected, voice.play_audio, after)
+        self.broadcast = broadcast
+        self.cursor = 0
+        broadcast.subscribe(self)
+
+    def _do_run(self):
+        try:
+            self.play_frames()
+        finally:
+            self.broadcast.unsubscribe(self)
+
+    def stop(self):
+        # a player stopped before it was started never runs _do_run, it still has to let go of the broadcast
+        super().stop()
+        self.broadcast.unsubscribe(self)
+
+    def play_frames(self):
+        self.loops = 0
+        self._start = time.time()
+        while not self._end.is_set():
+            if not self._resumed.is_set():
+                self._resumed.wait()
+                self._start = time.time()
+                self.loops = 0
+            if not self._connected.is_set():
+                self.stop()
+                break
+            frame = self.broadcast.frame(self)
+            if frame is None:
+                self.stop()
+                break
+            self.loops += 1
+            pcm, opus = frame
+            lateness = time.time() - self._start - self.delay * (self.loops - 1)
+            metrics.observe('frame_send_lateness_seconds', max(0, lateness))
+            if self._volume != 1.0:
+                self.player(audioop.mul(pcm, 2, min(self._volume, 2.0)))
+            else:
+                self.player(opus, encode=False)
+            self.broadcast.advance(self)
+            next_time = self._start + self.delay * self.loops
+            delay = max(0, self.delay + (next_time - time.time()))
+            time.sleep(delay)
+
+
+class Broadcaster:
+    """
+    Hands out shared TrackBroadcasts, so servers starting the same track within the join window share one ffmpeg.
+    With an audio_cache, new broadcasts also write their frames into the cache.
+    """
+    def __init__(self, join_window=10, audio_cache=None):
+        self.join_window = join_window
+        self.audio_cache = audio_cache
+        self.broadcasts = {}
+
+    def create_player(self, info, voice, after=None):
+        """
+        subscribes a voice client to the broadcast of a track, starting one if none can be joined.
+        :param info: youtube_dl info dict
+        :param voice: discord voice client
+        :param after: called when the player is done
+        :return: BroadcastPlayer
+        """
+        video_id = info['id']
+        broadcast = self.broadcasts.get(video_id)
+        if broadcast is None or not broadcast.can_join():
+            cache_file = self.audio_cache.open_writer(info) if self.audio_cache is not None else None
+            broadcast = TrackBroadcast(video_id, info['url'], self.join_window, cache=self.audio_cache,
+                                       cache_file=cache_file)
+            self.broadcasts[video_id] = broadcast
+            player = BroadcastPlayer(broadcast, voice, after)
+            broadcast.producer.start()
+        else:
+            player = BroadcastPlayer(broadcast, voice, after)
+        for stale in [key for key, value in self.broadcasts.items() if value.finished]:
+            del self.broadcasts[stale]
+        return player
+
+
+class Playlist:
+    """
+    Song queue of one server. Entries sit in a list with a moving head, so taking the next song and removing a known
+    entry only clear a slot (O(1)). The list is only compacted once the cleared slots make up half of it. A Fenwick
+    tree counts the songs left in the slots, so indexed access and paging find their position in O(log n) in between.
+    Moving and shuffling are O(n).
+    """
+    def __init__(self, max_size=1000, per_user=50):
+        self.max_size = max_size
+        self.per_user = per_user
+        self.slots = []
+        self.tree = [0]
+        self.head = 0
+        self.holes = 0
+        self.positions = {}
+        self.user_counts = {}
+        self.not_empty = asyncio.Event()
+
+    def __len__(self):
+        return len(self.slots) - self.head - self.holes
+
+    def __iter__(self):
+        for position in range(self.head, len(self.slots)):
+            if self.slots[position] is not None:
+                yield self.slots[position]
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError('playlist index out of range')
+        return self.slots[self.locate(index)]
+
+    def is_full(self):
+        return len(self) >= self.max_size
+
+    def user_is_full(self, user):
+        return self.user_counts.get(user.id, 0) >= self.per_user
+
+    def compact(self):
+        if self.head == 0 and self.holes == 0:
+            return
+        self.slots = [entry for entry in self.slots[self.head:] if entry is not None]
+        self.head = 0
+        self.holes = 0
+        self.reindex(0)
+        self.rebuild()
+
+    def reindex(self, start, end=None):
+        for position in range(start, len(self.slots) if end is None else end):
+            if self.slots[position] is not None:
+                self.positions[self.slots[position]] = position
+
+    def rebuild(self):
+        """
+        rebuilds the Fenwick tree of filled slots in O(n).
+        :return: None
+        """
+        tree = [0] + [0 if entry is None else 1 for entry in self.slots]
+        for index in range(1, len(tree)):
+            parent = index + (index & -index)
+            if parent < len(tree):
+                tree[parent] += tree[index]
+        self.tree = tree
+
+    def filled_before(self, position):
+        total = 0
+        while position > 0:
+            total += self.tree[position]
+            position -= position & -position
+        return total
+
+    def clear_slot(self, position):
+        self.slots[position] = None
+        position += 1
+        while position < len(self.tree):
+            self.tree[position] -= 1
+            position += position & -position
+
+    def locate(self, index):
+        """
+        finds the slot of the song at an index in O(log n).
+        :param index: index in the queue, must be in range
+        :return: position in slots
+        """
+        position = 0
+        remaining = index + 1
+        step = 1 << (len(self.tree) - 1).bit_length() >> 1
+        while step:
+            if position + step < len(self.tree) and self.tree[position + step] < remaining:
+                position += step
+                remaining -= self.tree[position]
+            step >>= 1
+        return position
+
+    def count(self, entry, change):
+        user_id = entry.author.id
+        self.user_counts[user_id] = self.user_counts.get(user_id, 0) + change
+        if self.user_counts[user_id] <= 0:
+            del self.user_counts[user_id]
+
+    def put(self, entry):
+        """
+        adds a song to the end of the queue. check is_full and user_is_full first.
+        :param entry: JoinVoice
+        :return: None
+        """
+        index = len(self.slots) + 1
+        self.tree.append(1 + self.filled_before(index - 1) - self.filled_before(index - (index & -index)))
+        self.positions[entry] = len(self.slots)
+        self.slots.append(entry)
+        self.count(entry, 1)
+        self.not_empty.set()
+
+    async def get(self):
+        """
+        waits for and removes the next song.
+        :return: JoinVoice
+        """
+        while not len(self):
+            self.not_empty.clear()
+            await self.not_empty.wait()
+        while self.slots[self.head] is None:
+            self.head += 1
+            self.holes -= 1
+        entry = self.slots[self.head]
+        self.clear_slot(self.head)
+        self.head += 1
+        del self.positions[entry]
+        self.count(entry, -1)
+        if self.head * 2 > len(self.slots):
+            self.compact()
+        return entry
+
+    def remove(self, entry):
+        """
+        removes a song from anywhere in the queue in constant time (O(log n) with the tree update).
+        :param entry: JoinVoice
+        :return: None
+        """
+        self.clear_slot(self.positions.pop(entry))
+        self.holes += 1
+        self.count(entry, -1)
+        if (self.head + self.holes) * 2 > len(self.slots):
+            self.compact()
+
+    def pop(self, index):
+        entry = self[index]
+        self.remove(entry)
+        return entry
+
+    def move(self, old, new):
+        """
+        moves the song at index old to index new.
+        :return: the moved JoinVoice
+        """
+        entry = self[old]
+        position = self.positions[entry]
+        target = self.positions[self[new]]
+        low, high = min(position, target), max(position, target) + 1
+        holes_between = None in self.slots[low:high]
+        self.slots.insert(target, self.slots.pop(position))
+        self.reindex(low, high)
+        if holes_between:
+            # cleared slots moved, the tree only stays valid if every slot that shifted was filled
+            self.rebuild()
+        return entry
+
+    def shuffle(self):
+        self.compact()
+        random.shuffle(self.slots)
+        self.reindex(0)
+
+    def page(self, start, count):
+        """
+        returns up to count songs starting at index start, without copying the rest of the queue.
+        :return: list of JoinVoice
+        """
+        if start >= len(self):
+            return []
+        songs = []
+        position = self.locate(start)
+        while position < len(self.slots) and len(songs) < count:
+            if self.slots[position] is not None:
+                songs.append(self.slots[position])
+            position += 1
+        return songs
 
 
 class CurrentStatus:
     """
     Keeps track of the current state per each server.
     """
-    def __init__(self, bot):
+    prefetch_count = 2
+    prefetch_lead = 30
+
+    def __init__(self, bot, resolver, audio_cache=None, broadcaster=None):
         self.current = None
         self.voice = None
         self.bot = bot
+        self.resolver = resolver
+        self.audio_cache = audio_cache
+        self.broadcaster = broadcaster
+        self.prefetch_handle = None
         self.play_next_song = asyncio.Event()
-        self.current_queue = asyncio.Queue()
+        self.current_queue = Playlist()
         self.audio_player = self.bot.loop.create_task(self.create_audio_player())
 
     def is_playing(self):
@@ -45,7 +954,7 @@ class CurrentStatus:
         Checks if the player is playing any music.
         :return: Boolean
         """
-        if self.voice is None or self.current is None:
+        if self.voice is None or self.current is None or self.current.player is None:
             return False
         player = self.current.player
         return not player.is_done()
@@ -61,11 +970,69 @@ class CurrentStatus:
     def toggle_next(self):
         self.bot.loop.call_soon_threadsafe(self.play_next_song.set)
 
+    def prefetch_upcoming(self):
+        """
+        resolves (or refreshes) the next songs in the queue so they can start without a gap.
+        :return: None
+        """
+        for entry in self.current_queue.page(0, self.prefetch_count):
+            self.resolver.prefetch(entry)
+
+    def create_player(self, entry):
+        """
+        creates the player for a resolved entry, copying the youtube_dl info discord.py's ytdl player exposes.
+        tracks in the audio cache are played from disk, others through a shared broadcast (or ffmpeg) and are cached in
+        the background.
+        :param entry: JoinVoice
+        :return: player
+        """
+        info = entry.info
+        cached = None
+        if self.audio_cache is not None:
+            cached = self.audio_cache.get(info.get('id'))
+        if cached is not None:
+            player = OpusCachePlayer(cached, self.voice, after=self.toggle_next)
+        else:
+            if self.broadcaster is not None and info.get('id') and not info.get('is_live'):
+                # the broadcast writes its frames into the audio cache itself
+                player = self.broadcaster.create_player(info, self.voice, after=self.toggle_next)
+            else:
+                player = self.voice.create_ffmpeg_player(info['url'], after=self.toggle_next)
+                if self.audio_cache is not None:
+                    self.audio_cache.fill(info)
+        player.download_url = info['url']
+        player.url = info.get('webpage_url', entry.query)
+        player.title = info.get('title')
+        player.duration = info.get('duration')
+        player.uploader = info.get('uploader')
+        player.is_live = bool(info.get('is_live'))
+        return player
+
     async def create_audio_player(self):
         while True:
             self.play_next_song.clear()
             self.current = await self.current_queue.get()
-            await self.bot.send_message(self.current.channel, '**Now playing** :notes: {}'.format(str(self.current)))
+            try:
+                await self.resolver.prefetch(self.current)
+                self.current.player = self.create_player(self.current)
+            except Exception as e:
+                await self.bot.send_message(self.current.channel, 'Error occurred: ' + str(e))
+                continue
+
+            if self.prefetch_handle is not None:
+                self.prefetch_handle.cancel()
+            self.prefetch_upcoming()
+            duration = self.current.player.duration
+            if duration and duration > self.prefetch_lead:
+                self.prefetch_handle = self.bot.loop.call_later(duration - self.prefetch_lead, self.prefetch_upcoming)
+
+            try:
+                await self.bot.send_message(self.current.channel,
+                                            '**Now playing** :notes: {}'.format(str(self.current)))
+            except BaseException:
+                # the player never starts, stopping it releases its broadcast
+                self.current.player.stop()
+                raise
             self.current.player.start()
             await self.play_next_song.wait()
 
@@ -78,11 +1045,25 @@ class Music:
     def __init__(self, bot):
         self.bot = bot
         self.voice_status = {}
+        self.resolver = TrackResolver(bot.loop, cache=MetadataCache(path=c.MUSIC_CACHE))
+        self.audio_cache = None
+        if c.AUDIO_CACHE:
+            self.audio_cache = AudioCache(c.AUDIO_CACHE, c.AUDIO_CACHE_SIZE, bot.loop)
+        self.broadcaster = Broadcaster(audio_cache=self.audio_cache) if c.SHARED_TRANSCODE else None
+        metrics.add_gauge('music_queue_depth', self.queue_depths)
+        metrics.add_gauge('metadata_cache_lookups_total', self.cache_lookups, 'counter')
+
+    def cache_lookups(self):
+        cache = self.resolver.cache
+        return {(('result', 'hit'),): cache.hits, (('result', 'miss'),): cache.misses}
+
+    def queue_depths(self):
+        return {(('server', server_id),): len(status.current_queue) for server_id, status in self.voice_status.items()}
 
     def get_status(self, server):
         status = self.voice_status.get(server.id)
         if status is None:
-            status = CurrentStatus(self.bot)
+            status = CurrentStatus(self.bot, self.resolver, self.audio_cache, self.broadcaster)
             self.voice_status[server.id] = status
         return status
 
@@ -99,6 +1080,17 @@ class Music:
                     self.bot.loop.create_task(status.voice.disconnect())
             except:
                 pass
+        self.close()
+
+    def close(self):
+        """
+        stops the resolver and audio cache workers and saves the metadata cache. called when the cog is unloaded or the
+        bot shuts down.
+        :return: None
+        """
+        self.resolver.shutdown()
+        if self.audio_cache is not None:
+            self.audio_cache.shutdown()
 
     @commands.command(pass_context=True)
     async def summon(self, ctx):
@@ -117,44 +1109,34 @@ class Music:
         return True
 
     @commands.command(pass_context=True)
-    async def play(self, ctx, url):
+    async def play(self, ctx, *, url):
         """
         plays the audio of the youtube url given. if no url is given, it instead searches youtube for the song.
+        the song is queued right away, youtube_dl resolves it in the background once it is one of the next songs.
         :param url: url of the song. if a legitimate url is not given (i.e. a search term), it searches the criteria on
                     youtube
         :return: None
         """
         status = self.get_status(ctx.message.server)
-        print(status)
-        options = {
-            'default_search': 'auto',
-            'quiet': True
-        }
 
         if status.voice is None:
             join = await ctx.invoke(self.summon)
             if not join:
                 return 0
 
-        try:
-            if url.startswith('http'):
-                player = await status.voice.create_ytdl_player(url, ytdl_options=options, after=status.toggle_next)
-            else:
-                for attr, value in ctx.__dict__.items():
-                    url = value.content[6:]
-                    print(url)
-                    break
-                player = await status.voice.create_ytdl_player(url, ytdl_options=options,
-                                                               after=status.toggle_next)
-            print(player)
-        except Exception as e:
-            await self.bot.say('Error occurred: ' + str(e))
-        else:
-            song = JoinVoice(ctx.message, player)
-            print(song)
-            print(ctx.message)
-            await self.bot.say('{} added to queue. :white_check_mark:'.format(str(song)))
-            await status.current_queue.put(song)
+        if status.current_queue.is_full():
+            await self.bot.say('`The queue is full.`')
+            return
+        if status.current_queue.user_is_full(ctx.message.author):
+            await self.bot.say('`You already have {} songs in the queue.`'.format(status.current_queue.per_user))
+            return
+
+        song = JoinVoice(ctx.message, url)
+        if len(status.current_queue) < status.prefetch_count:
+            # songs further back are resolved by prefetch_upcoming once they move up
+            self.resolver.prefetch(song)
+        await self.bot.say('{} added to queue. :white_check_mark:'.format(str(song)))
+        status.current_queue.put(song)
 
     @commands.command(pass_context=True)
     async def pause(self, ctx):
@@ -206,7 +1188,7 @@ class Music:
         """
         status = self.get_status(ctx.message.server)
         if not status.is_playing():
-            await bot.say('`Not playing anything.`')
+            await self.bot.say('`Not playing anything.`')
             return 0
         status.skip()
         await self.bot.say(':fast_forward: **Skipped!**')
@@ -221,6 +1203,9 @@ class Music:
         status = self.get_status(ctx.message.server)
         player = status.player
         if volume_level and 0 <= int(volume_level) <= 200:
+            if isinstance(player, OpusCachePlayer):
+                await self.bot.say(":loudspeaker: `This song plays from the audio cache, its volume can't be changed.`")
+                return
             player.volume = int(volume_level) / 100
             await self.bot.say(':loudspeaker: `Volume set to {}'.format(str(int(player.volume * 100))) + '`')
             return
@@ -236,27 +1221,79 @@ class Music:
         :return: None
         """
         status = self.get_status(ctx.message.server)
-        await bot.say('`Disconnecting` :wave:')
+        await self.bot.say('`Disconnecting` :wave:')
         del self.voice_status[ctx.message.server.id]
         await status.voice.disconnect()
 
     @commands.command(pass_context=True)
-    async def queue(self, ctx):
+    async def queue(self, ctx, page=1):
         """
-        returns the current queue if there is a queue.
+        returns a page of the current queue if there is a queue.
+        :param page: page number, 10 songs per page
         :return: None
         """
         status = self.get_status(ctx.message.server)
-        if status.current_queue and status.is_playing():
-            embed = discord.Embed(title='Music Queue')
+        if not status.is_playing():
+            await self.bot.say('**Nothing in queue.**')
+            return
+
+        per_page = 10
+        queued = status.current_queue
+        pages = max(1, -(-(len(queued) + 1) // per_page))
+        page = min(max(1, int(page)), pages)
+        first = (page - 1) * per_page
+        embed = discord.Embed(title='Music Queue')
+        if page == 1:
             embed.add_field(name="`1.` {}".format(str(status.current)), value="------------")
-            for i in range(len(status.current_queue._queue)):
-                embed.add_field(name="{}. {}".format('`' + str(int(i + 2)) + '`', str(status.current_queue._queue[i])),
-                                value="------------")
-            await self.bot.say(embed=embed)
-            print(status.current_queue)
+            songs = queued.page(0, per_page - 1)
         else:
-            await bot.say('**Nothing in queue.**')
+            songs = queued.page(first - 1, per_page)
+        start = first + 2 if page == 1 else first + 1
+        for i, song in enumerate(songs):
+            embed.add_field(name="`{}.` {}".format(start + i, str(song)), value="------------")
+        embed.set_footer(text='Page {}/{} - {} songs queued'.format(page, pages, len(queued)))
+        await self.bot.say(embed=embed)
+
+    @commands.command(pass_context=True)
+    async def remove(self, ctx, position: int):
+        """
+        removes a song from the queue.
+        :param position: position of the song as shown by !queue (2 is the next song)
+        :return: None
+        """
+        status = self.get_status(ctx.message.server)
+        try:
+            song = status.current_queue.pop(position - 2)
+        except IndexError:
+            await self.bot.say('`There is no song at position {}.`'.format(position))
+            return
+        await self.bot.say('{} removed from the queue. :wastebasket:'.format(str(song)))
+
+    @commands.command(pass_context=True)
+    async def move(self, ctx, old: int, new: int):
+        """
+        moves a song to another position in the queue.
+        :param old: current position of the song as shown by !queue
+        :param new: position to move it to
+        :return: None
+        """
+        status = self.get_status(ctx.message.server)
+        try:
+            song = status.current_queue.move(old - 2, new - 2)
+        except IndexError:
+            await self.bot.say('`Positions must be between 2 and {}.`'.format(len(status.current_queue) + 1))
+            return
+        await self.bot.say('{} moved to position {}.'.format(str(song), new))
+
+    @commands.command(pass_context=True)
+    async def shuffle(self, ctx):
+        """
+        shuffles the queue.
+        :return: None
+        """
+        status = self.get_status(ctx.message.server)
+        status.current_queue.shuffle()
+        await self.bot.say(':twisted_rightwards_arrows: **Shuffled!**')
 
 
 class TextCommands:
@@ -297,202 +1334,913 @@ class TextCommands:
                                             "Bot disconnects.", inline=False)
         embed.add_field(name="!volume 0-200", value="Changes the bot's volume from 0-200.", inline=False)
         embed.add_field(name="!skip", value="Skips the current song.", inline=False)
-        embed.add_field(name="!queue", value="Displays the current queue.", inline=False)
+        embed.add_field(name="!queue page", value="Displays a page of the current queue.", inline=False)
+        embed.add_field(name="!remove position", value="Removes the song at this position from the queue.",
+                        inline=False)
+        embed.add_field(name="!move from to", value="Moves a song to another position in the queue.", inline=False)
+        embed.add_field(name="!shuffle", value="Shuffles the queue.", inline=False)
         embed.add_field(name="!disconnect", value="Disconnects the bot.", inline=False)
-        embed.add_field(name="!trivia", value="Starts a game of trivia.", inline=False)
+        embed.add_field(name="!trivia category", value="Starts a game of trivia. A category (i.e. !trivia geography), "
+                                                      "level or question pack can be given to only ask those "
+                                                      "questions.", inline=False)
         embed.add_field(name="!halt", value="Stops a game of trivia in progress.", inline=False)
+        embed.add_field(name="!leaderboard game", value="Shows the server's all-time trivia scores, or the scores of "
+                                                         "this channel's last game.", inline=False)
         embed.add_field(name="!brother", value="May I have some loops", inline=False)
         embed.add_field(name="!help", value="Sends this message.", inline=False)
         await self.bot.say(embed=embed)
 
 
-class Trivia:
-    """"
-    All commands related to the trivia function.
+class QuestionBank:
     """
-    def __init__(self, bot, win_limit=10, hint_time=15):
-        self.bot = bot
-        self.win_limit = win_limit
-        self.hint_time = hint_time
-        self.is_running = False
-        self.current_question = None
-        self.questions = []
-        self.asked = []
-        self.scores = {}
-        self.trivia_channel = None
-        self.cancel = True
+    Every trivia question found in the trivia folder. Scanned once per process and shared (read-only) by every
+    Trivia cog and game.
+    Question files are memory-mapped and streamed record by record; the bank only keeps where each question sits in its
+    file (see QuestionStore), so memory per question stays flat however large the packs are. Because of that, a pack
+    must be updated by writing a new file and renaming it over the old one, never by rewriting it in place.
+    The scan of each file is kept in a binary cache keyed on path, mtime and size, so a file is only re-scanned after it
+    changes.
+    Questions are indexed by category, level and source file so filtered games never scan the whole bank.
+    """
+    _shared = None
+    cache_version = 4
+
+    def __init__(self, directory='trivia', cache_path=None):
+        self.directory = directory
+        self.cache_path = cache_path
+        self.questions = QuestionStore()
+        self.categories = {}
+        self.levels = {}
+        self.sources = {}
+
+        cached = self.read_cache()
+        entries = {}
+        for file in sorted(os.listdir(directory)):
+            if not file.startswith('questions.'):
+                continue
+            filepath = os.path.join(directory, file)
+            stat = os.stat(filepath)
+            if stat.st_size == 0:
+                continue
+            with open(filepath, 'rb') as qfile:
+                data = mmap.mmap(qfile.fileno(), 0, access=mmap.ACCESS_READ)
+            key = (stat.st_mtime_ns, stat.st_size)
+            entry = cached.get(filepath)
+            if entry is None or entry[0] != key:
+                entry = (key,) + self.scan_questions(data)
+            entries[filepath] = entry
+            key, offsets, sizes, categories, levels = entry
+            first = len(self.questions)
+            self.questions.add_file(data, offsets, sizes)
+            self.sources[self.normalize(file.split('.')[1])] = array('I', range(first, len(self.questions)))
+            for index, local in ((self.categories, categories), (self.levels, levels)):
+                for name, ids in local.items():
+                    index.setdefault(name, array('I')).extend(first + question_id for question_id in ids)
+
+        if entries != cached:
+            self.write_cache(entries)
+
+    @classmethod
+    def shared(cls, directory='trivia'):
+        """
+        returns the process-wide question bank, loading it on first use.
+        :param directory: folder holding the MoxQuizz question files
+        :return: QuestionBank
+        """
+        if cls._shared is None:
+            cls._shared = cls(directory, cache_path=c.TRIVIA_CACHE)
+        return cls._shared
 
-        data_questions = os.listdir('trivia')
+    @staticmethod
+    def normalize(name):
+        """
+        normalizes a category, level or source name for lookups (case and spacing don't matter).
+        :param name: string
+        :return: string
+        """
+        return ' '.join(name.lower().split())
 
-        for file in data_questions:
-            filepath = 'trivia' + os.path.sep + file
-            self.load_questions(filepath)
-            #print('Loaded:', filepath)
-        #print('Trivia questions done loading.')
+    def select(self, name):
+        """
+        finds the questions for a category, level or source file, in that order.
+        :param name: category, level or source name (i.e. 'geography', 'hard' or 'trivia2')
+        :return: array of question ids, or None if nothing matches
+        """
+        key = self.normalize(name)
+        for index in (self.categories, self.levels, self.sources):
+            if key in index:
+                return index[key]
+        return None
 
-    def load_questions(self, filepath):
-        with open(filepath, encoding='utf-8', errors='replace') as qfile:
-            lines = qfile.readlines()
+    def read_cache(self):
+        """
+        memory-maps the compiled cache and unpickles it. a missing, unreadable or outdated cache is treated as empty.
+        :return: dict of filepath -> ((mtime, size), offsets, sizes, categories, levels)
+        """
+        if not self.cache_path:
+            return {}
+        try:
+            with open(self.cache_path, 'rb') as cache_file:
+                with mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    version, entries = pickle.loads(mapped)
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+            return {}
+        if version != self.cache_version:
+            return {}
+        return entries
+
+    def write_cache(self, entries):
+        """
+        writes the compiled cache atomically. failing to write it only costs a re-scan on the next start.
+        :param entries: dict of filepath -> ((mtime, size), offsets, sizes, categories, levels)
+        :return: None
+        """
+        if not self.cache_path:
+            return
+        temp_path = self.cache_path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as cache_file:
+                pickle.dump((self.cache_version, entries), cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.cache_path)
+        except OSError:
+            pass
 
+    @classmethod
+    def scan_questions(cls, data):
+        """
+        indexes one question file without keeping any of its questions.
+        :param data: contents of the file (bytes or mmap)
+        :return: (offsets, sizes, categories, levels): byte offset and length of every record, and normalized category
+            and level names -> array of record numbers in this file
+        """
+        offsets = array('Q')
+        sizes = array('I')
+        categories = {}
+        levels = {}
+        for start, end, record in cls.parse_records(data):
+            if record[2]:
+                categories.setdefault(cls.normalize(record[2]), array('I')).append(len(offsets))
+            if record[4]:
+                levels.setdefault(cls.normalize(record[4]), array('I')).append(len(offsets))
+            offsets.append(start)
+            sizes.append(end - start)
+        return offsets, sizes, categories, levels
+
+    @staticmethod
+    def parse_records(data):
+        """
+        streams the records of a MoxQuizz question file, one line at a time.
+        :param data: contents of the file, or of a slice of it (bytes or mmap)
+        :return: generator of (start, end, (question, answer, category, regex, level, author, comment)), where start
+            and end are the byte offsets of the record in data
+        """
         question = None
         category = None
         answer = None
         regex = None
+        level = None
+        author = None
+        comment = None
+        start = None
         position = 0
-
-        while position < len(lines):
-            if lines[position].strip().startswith('#'):
-                position += 1
+        size = len(data)
+
+        while position < size:
+            newline = data.find(b'\n', position)
+            if newline == -1:
+                newline = size
+            line = data[position:newline].strip()
+            line_start = position
+            position = newline + 1
+            if line.startswith(b'#'):
                 continue
-            if lines[position].strip() == '':
+            if not line:
                 if question is not None and answer is not None:
-                    q = Question(question=question, answer=answer, category=category, regex=regex)
-                    self.questions.append(q)
-
+                    yield start, line_start, (question, answer, category, regex, level, author, comment)
                 question = None
                 category = None
                 answer = None
                 regex = None
-                position += 1
+                level = None
+                author = None
+                comment = None
+                start = None
                 continue
 
-            if lines[position].strip().lower().startswith('category'):
-                category = lines[position].strip()[lines[position].find(':') + 1:].strip()
-            elif lines[position].strip().lower().startswith('question'):
-                question = lines[position].strip()[lines[position].find(':') + 1:].strip()
-            elif lines[position].strip().lower().startswith('answer'):
-                answer = lines[position].strip()[lines[position].find(':') + 1:].strip()
-            elif lines[position].strip().lower().startswith('regexp'):
-                regex = lines[position].strip()[lines[position].find(':') + 1:].strip()
-            position += 1
+            if start is None:
+                start = line_start
+            key = line[:8].lower()
+            value = line[line.find(b':') + 1:].strip().decode('utf-8', 'replace')
+            if key.startswith((b'category', b'catgory')):
+                category = value
+            elif key.startswith(b'question'):
+                question = value
+            elif key.startswith(b'answer'):
+                answer = value
+            elif key.startswith(b'regexp'):
+                regex = value
+            elif key.startswith(b'level'):
+                level = value
+            elif key.startswith(b'author'):
+                author = value
+            elif key.startswith(b'comment'):
+                comment = value
+        if question is not None and answer is not None:
+            yield start, size, (question, answer, category, regex, level, author, comment)
+
+
+class QuestionStore:
+    """
+    Every question of the bank, stored as the byte offset and length of its record in the memory-mapped source file
+    (twelve bytes a question). A Question is only parsed when it is looked up, i.e. when a game draws it.
+    """
+    def __init__(self):
+        self.files = []
+        self.firsts = []
+        self.offsets = array('Q')
+        self.sizes = array('I')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def add_file(self, data, offsets, sizes):
+        """
+        appends the records of one question file.
+        :param data: contents of the file (bytes or mmap), kept to parse questions from later
+        :param offsets: array of record byte offsets, from QuestionBank.scan_questions
+        :param sizes: array of record byte lengths
+        :return: None
+        """
+        if not offsets:
+            return
+        self.files.append(data)
+        self.firsts.append(len(self.offsets))
+        self.offsets.extend(offsets)
+        self.sizes.extend(sizes)
+
+    def __getitem__(self, question_id):
+        start = self.offsets[question_id]
+        data = self.files[bisect.bisect_right(self.firsts, question_id) - 1]
+        for _, _, record in QuestionBank.parse_records(data[start:start + self.sizes[question_id]]):
+            return Question(*record)
+        raise IndexError('question {} changed on disk'.format(question_id))
+
+
+class QuestionPool:
+    """
+    Draws questions out of the shared question bank without replacement. The bank itself is never copied or changed,
+    each pool only keeps a sparse swap table of the positions it has drawn (a lazy Fisher-Yates shuffle).
+    If ids is given (i.e. a category from QuestionBank.select), only those questions are drawn.
+    """
+    def __init__(self, questions, ids=None):
+        self.questions = questions
+        self.ids = ids
+        self.size = len(questions) if ids is None else len(ids)
+        self.remaining = self.size
+        self.swapped = {}
+
+    def __len__(self):
+        return self.remaining
+
+    def draw(self):
+        """
+        picks a random question that has not been drawn since the last recycle, in constant time.
+        :return: Question
+        """
+        if self.remaining == 0:
+            self.recycle()
+        last = self.remaining - 1
+        position = random.randint(0, last)
+        picked = self.swapped.get(position, position)
+        self.swapped[position] = self.swapped.get(last, last)
+        self.swapped[last] = picked
+        self.remaining = last
+        if self.ids is not None:
+            picked = self.ids[picked]
+        return self.questions[picked]
+
+    def recycle(self):
+        """
+        puts every drawn question back into the pool, in constant time.
+        :return: None
+        """
+        self.remaining = self.size
+
+
+class TriviaScheduler:
+    """
+    Runs the hint and timeout events of every trivia session off a single timer. Pending events sit in a heap ordered
+    by deadline and only the earliest one is armed on the event loop, so a game never leaves sleeping coroutines behind.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.timers = []
+        self.counter = itertools.count()
+        self.handle = None
+
+    def schedule(self, delay, session, question, hint_number):
+        """
+        calls session.on_timer(question, hint_number) after delay seconds.
+        :return: the timer entry, used to cancel it
+        """
+        entry = [self.loop.time() + delay, next(self.counter), session, question, hint_number]
+        heapq.heappush(self.timers, entry)
+        if self.timers[0] is entry:
+            self.rearm()
+        return entry
+
+    @staticmethod
+    def cancel(entry):
+        entry[2] = None
+
+    def rearm(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        while self.timers and self.timers[0][2] is None:
+            heapq.heappop(self.timers)
+        if self.timers:
+            self.handle = self.loop.call_at(self.timers[0][0], self.fire)
+
+    def fire(self):
+        self.handle = None
+        now = self.loop.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, session, question, hint_number = heapq.heappop(self.timers)
+            if session is not None:
+                session.timer = None
+                self.loop.create_task(session.on_timer(question, hint_number))
+        self.rearm()
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        self.timers = []
+
+
+class MessageBatcher:
+    """
+    Outgoing messages of one channel. Messages queued within window seconds of each other are joined into a single
+    message (up to Discord's 2000 character limit), and sends are spaced to stay inside the channel's rate limit
+    bucket of rate messages per per seconds, so bursts turn into fewer, larger messages instead of 429s.
+    """
+    limit = 2000
+
+    def __init__(self, bot, channel, window=0.3, rate=5, per=5.0):
+        self.bot = bot
+        self.channel = channel
+        self.window = window
+        self.rate = rate
+        self.per = per
+        self.pending = deque()
+        self.sent = deque()
+        self.task = None
+
+    def send(self, content=None, embed=None):
+        """
+        queues a message. returns right away, the message goes out with the next batch.
+        :param content: text of the message
+        :param embed: optional discord.Embed, sent with the text queued before it
+        :return: None
+        """
+        self.pending.append((content, embed))
+        if self.task is None or self.task.done():
+            self.task = self.bot.loop.create_task(self.flush())
+
+    def next_batch(self):
+        lines = []
+        length = 0
+        while self.pending:
+            content, embed = self.pending[0]
+            if content is not None:
+                if lines and length + len(content) + 1 > self.limit:
+                    break
+                lines.append(content)
+                length += len(content) + 1
+            self.pending.popleft()
+            if embed is not None:
+                return '\n'.join(lines) or None, embed
+        return '\n'.join(lines), None
+
+    async def wait_for_bucket(self):
+        while True:
+            now = self.bot.loop.time()
+            while self.sent and self.sent[0] <= now - self.per:
+                self.sent.popleft()
+            if len(self.sent) < self.rate:
+                self.sent.append(now)
+                return
+            await asyncio.sleep(self.sent[0] + self.per - now)
+
+    async def flush(self):
+        await asyncio.sleep(self.window)
+        while self.pending:
+            await self.wait_for_bucket()
+            content, embed = self.next_batch()
+            try:
+                await self.bot.send_message(self.channel, content, embed=embed)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # a failed batch is dropped, the rest of the queue still goes out
+                metrics.inc('send_errors_total', ('error', type(e).__name__))
+
+
+class ScoreStore:
+    """
+    Trivia scores kept in SQLite (WAL mode), per user id and server: all-time totals plus the scores of every game.
+    Points are buffered in memory and written in batches (every flush_every points, after flush_interval seconds, at the
+    end of a game and before a leaderboard is read). Totals are indexed by points so top-N reads never scan the table.
+    Every shard writes to the same file, so a write waits at most busy_timeout seconds for the lock. A flush that
+    can't get it keeps the points buffered and is retried after retry_delay seconds.
+    """
+    schema = (
+        'CREATE TABLE IF NOT EXISTS scores (server_id TEXT NOT NULL, user_id TEXT NOT NULL, name TEXT NOT NULL, '
+        'points INTEGER NOT NULL, PRIMARY KEY (server_id, user_id))',
+        'CREATE INDEX IF NOT EXISTS scores_top ON scores (server_id, points DESC)',
+        'CREATE TABLE IF NOT EXISTS games (id INTEGER PRIMARY KEY, server_id TEXT NOT NULL, channel_id TEXT NOT NULL, '
+        'started REAL NOT NULL, ended REAL, winner_id TEXT)',
+        'CREATE INDEX IF NOT EXISTS games_channel ON games (channel_id, id DESC)',
+        'CREATE TABLE IF NOT EXISTS game_scores (game_id INTEGER NOT NULL, user_id TEXT NOT NULL, name TEXT NOT NULL, '
+        'points INTEGER NOT NULL, PRIMARY KEY (game_id, user_id))',
+        'CREATE INDEX IF NOT EXISTS game_scores_top ON game_scores (game_id, points DESC)',
+    )
+
+    def __init__(self, path, loop=None, flush_every=50, flush_interval=30, busy_timeout=0.1, retry_delay=5):
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            for statement in self.schema:
+                self.db.execute(statement)
+        # from here on writes run on the event loop, so they must not wait long for another shard
+        self.db.execute('PRAGMA busy_timeout = {}'.format(int(busy_timeout * 1000)))
+        self.loop = loop
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.retry_delay = retry_delay
+        self.retrying = False
+        self.handle = None
+        self.totals = {}
+        self.game_totals = {}
+        self.buffered = 0
+
+    def start_game(self, server_id, channel_id):
+        """
+        records a new game.
+        :return: id of the game, or None if the database is locked (the game's points are then not saved)
+        """
+        try:
+            with self.db:
+                cursor = self.db.execute('INSERT INTO games (server_id, channel_id, started) VALUES (?, ?, ?)',
+                                         (str(server_id), str(channel_id), time.time()))
+        except sqlite3.OperationalError:
+            metrics.inc('score_write_errors_total')
+            return None
+        return cursor.lastrowid
+
+    def add_point(self, game_id, server_id, user):
+        """
+        buffers a point for a correct answer.
+        :param game_id: from start_game
+        :param server_id: server the game runs in
+        :param user: discord user who answered
+        :return: None
+        """
+        key = (str(server_id), user.id)
+        self.totals[key] = (user.name, self.totals.get(key, (None, 0))[1] + 1)
+        key = (game_id, user.id)
+        self.game_totals[key] = (user.name, self.game_totals.get(key, (None, 0))[1] + 1)
+        self.buffered += 1
+        if self.buffered >= self.flush_every and not self.retrying:
+            self.flush()
+        elif self.handle is None and self.loop is not None:
+            self.handle = self.loop.call_later(self.flush_interval, self.flush)
+
+    def end_game(self, game_id, winner=None):
+        self.flush()
+        try:
+            with self.db:
+                self.db.execute('UPDATE games SET ended = ?, winner_id = ? WHERE id = ?',
+                                (time.time(), winner.id if winner is not None else None, game_id))
+        except sqlite3.OperationalError:
+            metrics.inc('score_write_errors_total')
+
+    def flush(self):
+        """
+        writes every buffered point in one transaction. if the database stays locked the points stay buffered.
+        :return: None
+        """
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if not self.buffered:
+            return
+        try:
+            self.write()
+        except sqlite3.OperationalError:
+            metrics.inc('score_write_errors_total')
+            if self.loop is not None:
+                self.retrying = True
+                self.handle = self.loop.call_later(self.retry_delay, self.flush)
+            return
+        self.retrying = False
+        self.totals = {}
+        self.game_totals = {}
+        self.buffered = 0
+
+    def write(self):
+        totals = [(server_id, user_id, name, points) for (server_id, user_id), (name, points) in self.totals.items()]
+        games = [(game_id, user_id, name, points) for (game_id, user_id), (name, points) in self.game_totals.items()]
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO scores VALUES (?, ?, ?, 0)',
+                                [row[:3] for row in totals])
+            self.db.executemany('UPDATE scores SET name = ?, points = points + ? WHERE server_id = ? AND user_id = ?',
+                                [(name, points, server_id, user_id) for server_id, user_id, name, points in totals])
+            self.db.executemany('INSERT OR IGNORE INTO game_scores VALUES (?, ?, ?, 0)',
+                                [row[:3] for row in games])
+            self.db.executemany('UPDATE game_scores SET name = ?, points = points + ? '
+                                'WHERE game_id = ? AND user_id = ?',
+                                [(name, points, game_id, user_id) for game_id, user_id, name, points in games])
+
+    def leaderboard(self, server_id, limit=10):
+        """
+        all-time top scores of a server.
+        :return: list of (name, points)
+        """
+        self.flush()
+        return self.db.execute('SELECT name, points FROM scores WHERE server_id = ? ORDER BY points DESC LIMIT ?',
+                               (str(server_id), limit)).fetchall()
+
+    def last_game(self, channel_id):
+        """
+        the game running or last played in a channel.
+        :return: id of the game, or None
+        """
+        row = self.db.execute('SELECT id FROM games WHERE channel_id = ? ORDER BY id DESC LIMIT 1',
+                              (str(channel_id),)).fetchone()
+        return row[0] if row is not None else None
+
+    def game_leaderboard(self, game_id, limit=10):
+        """
+        top scores of one game.
+        :return: list of (name, points)
+        """
+        self.flush()
+        return self.db.execute('SELECT name, points FROM game_scores WHERE game_id = ? ORDER BY points DESC LIMIT ?',
+                               (game_id, limit)).fetchall()
+
+    def close(self):
+        # shutting down, waiting for the lock is better than losing the points
+        self.db.execute('PRAGMA busy_timeout = 5000')
+        self.flush()
+        self.db.close()
+
+
+class TriviaSession:
+    """
+    Keeps track of one game of trivia per each channel.
+    """
+    countdown = 5
+
+    def __init__(self, bot, channel, questions, scheduler, store=None, win_limit=10, hint_time=15, hint_policy=None):
+        self.bot = bot
+        self.channel = channel
+        self.server_id = Trivia.session_key(channel)[0]
+        self.scheduler = scheduler
+        self.store = store
+        self.game_id = None
+        self.win_limit = win_limit
+        self.hint_time = hint_time
+        self.hint_policy = hint_policy
+        self.is_running = False
+        self.starting = None
+        self.current_question = None
+        self.questions = QuestionPool(questions)
+        self.asked = 0
+        self.scores = {}
+        self.names = {}
+        self.timer = None
+        self.outbox = MessageBatcher(bot, channel)
+
+    def say(self, content=None, embed=None):
+        self.outbox.send(content, embed)
 
     def trivia_start(self):
         return self.is_running
 
+    def is_active(self):
+        return self.is_running or self.starting is not None
+
     def question_in_progress(self):
         return self.current_question is not None
 
-    async def hint(self, hint_question, hint_number):
-        if self.is_running and self.current_question is not None:
-            await asyncio.sleep(self.hint_time)
-            if self.current_question == hint_question and self.cancel is False:
-                if hint_number >= 4:
-                    await self.next_question(self.trivia_channel)
-                hint = self.current_question.get_hint(hint_number)
-                await self.bot.say('`Hint {}:` {}'.format(hint_number, hint))
-                if hint_number < 4:
-                    await self.hint(hint_question, hint_number + 1)
+    def cancel_hints(self):
+        if self.timer is not None:
+            self.scheduler.cancel(self.timer)
+            self.timer = None
 
-    @commands.command(pass_context=True)
-    async def trivia(self, ctx):
-        if self.is_running:
-            await bot.say('`Trivia already started. Stop it with !halt.`')
-        else:
-            await self.reset()
-            self.trivia_channel = ctx.message.channel
-            await self.bot.say('`Trivia starting in 5 seconds...`')
-            await asyncio.sleep(5)
-            self.is_running = True
-            await self.ask_question()
+    async def on_timer(self, hint_question, hint_number):
+        """
+        called by the scheduler every hint_time seconds: gives hints 1-3, then moves on if no one has answered.
+        :param hint_question: the question the timer was set for
+        :param hint_number: the hint to give, 4 means the question timed out
+        :return: None
+        """
+        if not self.is_running or self.current_question is not hint_question:
+            return
+        if hint_number >= 4:
+            await self.next_question()
+            return
+        self.timer = self.scheduler.schedule(self.hint_time, self, hint_question, hint_number + 1)
+        self.say('`Hint {}:` {}'.format(hint_number, hint_question.get_hint(hint_number, self.hint_policy)))
+
+    async def start(self, ids=None):
+        """
+        starts a new game after a short countdown. the countdown can be called off with cancel_start.
+        :param ids: question ids to draw from (see QuestionBank.select). every question is used if not given.
+        :return: None
+        """
+        await self.reset()
+        self.questions = QuestionPool(self.questions.questions, ids)
+        self.say('`Trivia starting in {} seconds...`'.format(self.countdown))
+        self.starting = asyncio.ensure_future(asyncio.sleep(self.countdown))
+        try:
+            await self.starting
+        except asyncio.CancelledError:
+            return
+        finally:
+            self.starting = None
+        self.is_running = True
+        if self.store is not None:
+            self.game_id = self.store.start_game(self.server_id, self.channel.id)
+        await self.ask_question()
 
     async def reset(self):
         if self.is_running:
             await self.halt()
+        self.cancel_hints()
         self.current_question = None
-        self.cancel = True
         self.is_running = False
-        self.questions.append(self.asked)
-        self.asked = []
+        self.questions.recycle()
+        self.asked = 0
         self.scores = {}
+        self.names = {}
+
+    def end_game(self, winner=None):
+        if self.store is not None and self.game_id is not None:
+            self.store.end_game(self.game_id, winner)
+        self.game_id = None
+
+    def cancel_start(self):
+        """
+        calls off a game that is still counting down.
+        :return: Boolean, whether there was a countdown to call off
+        """
+        if self.starting is None:
+            return False
+        self.starting.cancel()
+        self.starting = None
+        self.say('`Trivia stopped.`')
+        return True
 
-    @commands.command(pass_context=True)
     async def halt(self):
-        if self.is_running:
-            await self.bot.say('`Trivia stopped.`')
-            if self.current_question is not None:
-                await self.bot.say('`The correct answer is` **{}**.'.format(self.current_question.get_answer()))
-            await self.print_scores()
-            self.current_question = None
-            self.cancel = True
-            self.is_running = False
-        else:
-            await self.bot.say('`Trivia is currently not running! Start one with !trivia.`')
+        self.cancel_hints()
+        self.say('`Trivia stopped.`')
+        if self.current_question is not None:
+            self.say('`The correct answer is` **{}**.'.format(self.current_question.get_answer()))
+        self.print_scores()
+        self.end_game()
+        self.current_question = None
+        self.is_running = False
 
     async def ask_question(self):
         if self.is_running:
-            q = random.randint(0, len(self.questions) - 1)
-            self.current_question = self.questions[q]
-            self.questions.remove(self.current_question)
-            self.asked.append(self.current_question)
-            await self.bot.say('`Question {}: {}`'.format(len(self.asked), self.current_question.ask_question()))
-            self.cancel = False
-            await self.hint(self.current_question, 1)
-
-    async def next_question(self, channel):
+            self.cancel_hints()
+            try:
+                self.current_question = self.questions.draw()
+            except IndexError:
+                # the question file was rewritten under the bot, none of its offsets can be trusted any more
+                self.say('`The trivia questions changed while the game was running, stopping.`')
+                await self.halt()
+                return
+            self.current_question.compile()
+            self.asked += 1
+            self.timer = self.scheduler.schedule(self.hint_time, self, self.current_question, 1)
+            self.say('`Question {}: {}`'.format(self.asked, self.current_question.ask_question()))
+
+    async def next_question(self):
         if self.is_running:
-            if self.trivia_channel:
-                await self.bot.say('`No one got it! The answer is` **{}.** `Next question!`'.format
-                                   (self.current_question.get_answer()))
-                self.current_question = None
-                self.cancel = True
-                await self.ask_question()
+            self.say('`No one got it! The answer is` **{}.** `Next question!`'.format(
+                self.current_question.get_answer()))
+            self.current_question = None
+            await self.ask_question()
 
-    async def answer_question(self, message):
-        #print('AQ function called.')
-        print(self.is_running, self.current_question)
+    async def answer_question(self, message, guess):
+        """
+        checks a chat message against the current question.
+        :param message: the discord message
+        :param guess: the message content, already passed through Question.prepare
+        :return: None
+        """
         if self.is_running and self.current_question is not None:
-            print('AQ in if.')
-            if self.current_question.answer_check(message.content):
-                print('right answer')
-                self.cancel = True
-                if message.author.name in self.scores:
-                    self.scores[message.author.name] += 1
-                else:
-                    self.scores[message.author.name] = 1
-                await self.bot.say('**{}** `is correct. The answer was` **{}.**'.format(message.author.name,
-                                                                                    self.current_question.get_answer()))
-
-                if self.scores[message.author.name] == self.win_limit:
-                    await self.print_scores()
-                    await self.bot.say('**{}** `has won! Congratulations!`'.format(message.author.name))
-                    self.questions.append(self.asked)
-                    self.asked = []
+            started = time.perf_counter()
+            correct = self.current_question.answer_check(guess)
+            metrics.observe('answer_check_seconds', time.perf_counter() - started)
+            if correct:
+                question = self.current_question
+                self.current_question = None
+                self.cancel_hints()
+                author = message.author
+                self.scores[author.id] = self.scores.get(author.id, 0) + 1
+                self.names[author.id] = author.name
+                if self.store is not None and self.game_id is not None:
+                    self.store.add_point(self.game_id, self.server_id, author)
+                self.say('**{}** `is correct. The answer was` **{}.**'.format(message.author.name,
+                                                                          question.get_answer()))
+
+                if self.scores[author.id] == self.win_limit:
+                    self.print_scores()
+                    self.say('**{}** `has won! Congratulations!`'.format(author.name))
+                    self.end_game(author)
+                    self.questions.recycle()
+                    self.asked = 0
                     self.is_running = False
-                elif len(self.asked) % 5 == 0:
-                    await self.print_scores()
+                elif self.asked % 5 == 0:
+                    self.print_scores()
                 await self.ask_question()
 
-    async def print_scores(self):
-        if self.is_running:
-            await self.bot.say('`Current trivia scores:`')
+    def print_scores(self):
+        """
+        sends the scoreboard as a single embed.
+        :return: None
+        """
+        if len(self.scores) == 0:
+            self.say('**No trivia scores to show.**')
+            return
+
+        ranked = sorted(((self.names[user_id], score) for user_id, score in self.scores.items()),
+                        key=lambda item: item[1], reverse=True)
+        leaders = [name for name, score in ranked if score == ranked[0][1]]
+        title = 'Current trivia scores' if self.is_running else 'Most recent trivia scores'
+        embed = discord.Embed(title=title, description='Current leader(s): **{}**'.format(', '.join(leaders)))
+        for name, score in ranked[:25]:
+            embed.add_field(name=name, value=str(score))
+        self.say(embed=embed)
+
+
+class Trivia:
+    """"
+    All commands related to the trivia function. Every channel gets its own game, see TriviaSession.
+    hint_policy picks how hints reveal the answer (Question.reveal_columns or Question.reveal_from_start).
+    """
+    def __init__(self, bot, win_limit=10, hint_time=15, hint_policy=None):
+        self.bot = bot
+        self.win_limit = win_limit
+        self.hint_time = hint_time
+        self.hint_policy = hint_policy
+        self.bank = QuestionBank.shared()
+        self.sessions = {}
+        self.channels = {}
+        self.scheduler = TriviaScheduler(bot.loop)
+        self.store = ScoreStore(c.TRIVIA_DB, bot.loop) if c.TRIVIA_DB else None
+
+    @staticmethod
+    def session_key(channel):
+        server = getattr(channel, 'server', None)
+        return server.id if server is not None else None, channel.id
+
+    def get_session(self, channel):
+        key = self.session_key(channel)
+        session = self.sessions.get(key)
+        if session is None:
+            session = TriviaSession(self.bot, channel, self.bank.questions, self.scheduler, self.store, self.win_limit,
+                                    self.hint_time, self.hint_policy)
+            self.sessions[key] = session
+            self.channels[channel.id] = session
+        return session
+
+    def remove_session(self, channel):
+        self.channels.pop(channel.id, None)
+        return self.sessions.pop(self.session_key(channel), None)
+
+    def __unload(self):
+        self.close()
+
+    def close(self):
+        """
+        stops the trivia timers and writes the buffered scores. called when the cog is unloaded or the bot shuts down.
+        :return: None
+        """
+        self.scheduler.stop()
+        if self.store is not None:
+            self.store.close()
+
+    @commands.command(pass_context=True)
+    async def trivia(self, ctx, *, category=None):
+        """
+        starts a game of trivia in the requester's channel.
+        :param category: optional category, level or question pack to draw questions from (i.e. !trivia geography)
+        :return: None
+        """
+        ids = None
+        if category:
+            ids = self.bank.select(category)
+            if not ids:
+                await self.bot.say('`No trivia questions found for {}.`'.format(category))
+                return
+        session = self.get_session(ctx.message.channel)
+        if session.is_active():
+            await self.bot.say('`Trivia already started. Stop it with !halt.`')
         else:
-            await self.bot.say('`Most recent trivia scores:`')
+            await session.start(ids)
 
-        highest = 0
-        for name in self.scores:
-            await self.bot.say('{}: {}'.format(name, self.scores[name]))
-            if self.scores[name] > highest:
-                highest = self.scores[name]
-        if len(self.scores) == 0:
-            self.bot.say('**No trivia scores to show.**')
+    @commands.command(pass_context=True)
+    async def halt(self, ctx):
+        """
+        stops the game of trivia running in the requester's channel.
+        :return: None
+        """
+        channel = ctx.message.channel
+        session = self.sessions.get(self.session_key(channel))
+        if session is None or not session.is_active():
+            self.remove_session(channel)
+            await self.bot.say('`Trivia is currently not running! Start one with !trivia.`')
+            return
+        if not session.cancel_start():
+            await session.halt()
+        self.remove_session(channel)
 
-        leaders = []
-        for name in self.scores:
-            if self.scores[name] == highest:
-                leaders.append(name)
-        await self.bot.say('`Current leader(s):` **{}**'.format(leaders))
+    @commands.command(pass_context=True)
+    async def leaderboard(self, ctx, scope=None):
+        """
+        shows the all-time trivia leaderboard of the server, or the scores of the channel's last game.
+        :param scope: 'game' for the channel's current or last game
+        :return: None
+        """
+        if self.store is None:
+            await self.bot.say('`Trivia scores are not being saved.`')
+            return
+        title = 'Trivia Leaderboard'
+        if scope == 'game':
+            game_id = self.store.last_game(ctx.message.channel.id)
+            leaders = self.store.game_leaderboard(game_id) if game_id is not None else []
+            title = 'Trivia Leaderboard (last game)'
+        else:
+            leaders = self.store.leaderboard(self.session_key(ctx.message.channel)[0])
+        if not leaders:
+            await self.bot.say('**No trivia scores to show.**')
+            return
+        embed = discord.Embed(title=title)
+        for rank, (name, points) in enumerate(leaders, 1):
+            embed.add_field(name='`{}.` {}'.format(rank, name), value=str(points), inline=False)
+        await self.bot.say(embed=embed)
+
+    async def answer_question(self, message):
+        """
+        hands a chat message to the trivia game in its channel. cheap checks (is a question live in this channel, can
+        the length and first letter match) run first so ordinary chat never reaches the matcher.
+        :param message: the discord message
+        :return: None
+        """
+        session = self.channels.get(message.channel.id)
+        if session is None or session.current_question is None:
+            return
+        guess = session.current_question.prepare(message.content)
+        if not session.current_question.might_match(guess):
+            return
+        await session.answer_question(message, guess)
+        if not session.is_running and self.channels.get(message.channel.id) is session:
+            self.remove_session(message.channel)
 
 
 class Question:
     """
     Class for the questions for trivia.
+    Plain answers are matched with a bounded edit distance: up to one typo per five letters, at most max_typos, and
+    none for answers with digits.
     """
-    def __init__(self, question, answer, category=None, regex=None):
+    max_typos = c.TRIVIA_MAX_TYPOS
+    articles = ('the ', 'a ', 'an ')
+    __slots__ = ('question', 'answer', 'category', 'regex', 'level', 'author', 'comment', 'hints', 'matcher',
+                 'accepted', 'typos', 'lengths', 'initials', 'hint_cache')
+
+    def __init__(self, question, answer, category=None, regex=None, level=None, author=None, comment=None):
         self.question = question
         self.answer = answer
         self.category = category
         self.regex = regex
+        self.level = level
+        self.author = author
+        self.comment = comment
         self.hints = 0
+        self.matcher = None
+        self.accepted = None
+        self.typos = 0
+        self.lengths = None
+        self.initials = None
+        self.hint_cache = None
 
     def ask_question(self):
         if self.category is None:
@@ -502,46 +2250,305 @@ class Question:
         question_text += self.question
         return question_text
 
-    def answer_check(self, answer):
-        print('AC function called.')
+    @staticmethod
+    def normalize(answer):
+        """
+        normalizes a guess once per message so it can be checked with answer_check.
+        :param answer: raw message content
+        :return: string
+        """
+        return answer.strip().lower()
+
+    @classmethod
+    def simplify(cls, answer):
+        """
+        normalizes a plain answer or guess for fuzzy matching: lowercase, no accents, no leading article, no
+        surrounding punctuation and single spaces.
+        :param answer: string
+        :return: string
+        """
+        answer = unicodedata.normalize('NFKD', answer.lower())
+        answer = ' '.join(''.join(letter for letter in answer if not unicodedata.combining(letter)).split())
+        for article in cls.articles:
+            if answer.startswith(article) and len(answer) > len(article):
+                answer = answer[len(article):]
+                break
+        return answer.strip('.,!?\'" ')
+
+    @staticmethod
+    def within_distance(guess, answer, limit):
+        """
+        bounded Levenshtein check: only the diagonal band of width limit is computed, and it stops as soon as every
+        cell in a row is over the limit.
+        :return: Boolean
+        """
+        if abs(len(guess) - len(answer)) > limit:
+            return False
+        over = limit + 1
+        previous = [column if column <= limit else over for column in range(len(answer) + 1)]
+        for row in range(1, len(guess) + 1):
+            current = [over] * (len(answer) + 1)
+            if row <= limit:
+                current[0] = row
+            letter = guess[row - 1]
+            best = current[0]
+            for column in range(max(1, row - limit), min(len(answer), row + limit) + 1):
+                value = min(previous[column - 1] + (letter != answer[column - 1]), previous[column] + 1,
+                            current[column - 1] + 1)
+                current[column] = value
+                if value < best:
+                    best = value
+            if best > limit:
+                return False
+            previous = current
+        return previous[len(answer)] <= limit
+
+    def compile(self):
+        """
+        builds the answer matcher once, when the question is first asked. the Regexp field is compiled case-insensitive;
+        otherwise the answer (without MoxQuizz '#' marks) and the '#'-marked part are both accepted, simplified once
+        here and matched with a few typos allowed.
+        :return: None
+        """
+        if self.matcher is not None:
+            return
         if self.regex is not None:
-            match = re.fullmatch(self.regex.strip(), answer.strip())
-            return match is not None
-        return answer.lower().strip() == self.answer.lower().strip()
-
-    def get_hint(self, hint_number):
-        hint = []
-        for i in range(len(self.answer)):
-            if i % 5 < hint_number:
-                hint = hint + list(self.answer[i])
-            else:
-                if self.answer[i] == ' ':
-                    hint += '  '
-                else:
-                    hint += '_ '
-        return '`' + ''.join(hint) + '`'
+            try:
+                self.matcher = re.compile(self.regex.strip(), re.IGNORECASE).fullmatch
+                return
+            except re.error:
+                pass
+        accepted = {self.simplify(self.get_answer())}
+        marked = self.answer.split('#')
+        if len(marked) >= 3:
+            accepted.add(self.simplify(marked[1]))
+        self.accepted = frozenset(accepted)
+        if any(letter.isdigit() for answer in accepted for letter in answer):
+            self.typos = 0
+        else:
+            self.typos = min(self.max_typos, min(len(answer) for answer in accepted) // 5)
+        self.matcher = self.fuzzy_match
+        self.lengths = frozenset(len(answer) + change for answer in accepted
+                                 for change in range(-self.typos, self.typos + 1))
+        self.initials = frozenset(answer[:1] for answer in accepted) if self.typos == 0 else None
+
+    def fuzzy_match(self, answer):
+        if answer in self.accepted:
+            return True
+        return self.typos > 0 and any(self.within_distance(answer, accepted, self.typos) for accepted in self.accepted)
+
+    def prepare(self, answer):
+        """
+        normalizes a message once for this question: simplified for plain answers, only lowercased for a Regexp.
+        :param answer: raw message content
+        :return: string to pass to might_match and answer_check
+        """
+        if self.matcher is None:
+            self.compile()
+        if self.accepted is None:
+            return self.normalize(answer)
+        return self.simplify(answer)
+
+    def might_match(self, answer):
+        """
+        cheap length (and, without typos allowed, first letter) check, so most chat is rejected before answer_check.
+        questions with a Regexp always pass.
+        :param answer: guess, already passed through Question.prepare
+        :return: Boolean
+        """
+        if self.lengths is None:
+            return True
+        return len(answer) in self.lengths and (self.initials is None or answer[:1] in self.initials)
+
+    def answer_check(self, answer):
+        """
+        checks a guess against the answer.
+        :param answer: guess, already passed through Question.prepare
+        :return: Boolean
+        """
+        if self.matcher is None:
+            self.compile()
+        return bool(self.matcher(answer))
+
+    @staticmethod
+    def reveal_columns(answer):
+        """
+        hint policy: every hint reveals one more letter out of each group of five.
+        :param answer: the answer shown to players
+        :return: list with the positions newly revealed by each hint
+        """
+        return [list(range(column, len(answer), 5)) for column in range(5)]
+
+    @staticmethod
+    def reveal_from_start(answer, steps=4):
+        """
+        hint policy: hints reveal the answer from left to right in equal steps.
+        :param answer: the answer shown to players
+        :param steps: number of hints until the whole answer is shown
+        :return: list with the positions newly revealed by each hint
+        """
+        step = -(-len(answer) // steps)
+        return [list(range(start, min(start + step, len(answer)))) for start in range(0, step * steps, step)]
+
+    def render_hints(self, policy):
+        """
+        renders every hint for the question in one pass, revealing letters into a single buffer.
+        :param policy: function returning the positions revealed by each hint (i.e. Question.reveal_columns)
+        :return: list of hint strings, one per hint number
+        """
+        answer = self.get_answer()
+        buffer = ['  ' if letter == ' ' else '_ ' for letter in answer]
+        hints = []
+        for positions in policy(answer):
+            for position in positions:
+                buffer[position] = answer[position]
+            hints.append('`' + ''.join(buffer) + '`')
+        return hints
+
+    def get_hint(self, hint_number, policy=None):
+        """
+        returns a hint, rendering the question's hints the first time one is asked for.
+        :param hint_number: 1 for the first hint. numbers past the last hint return the last hint.
+        :param policy: hint reveal policy, Question.reveal_columns if not given
+        :return: string
+        """
+        if policy is None:
+            policy = Question.reveal_columns
+        if self.hint_cache is None or self.hint_cache[0] is not policy:
+            self.hint_cache = (policy, self.render_hints(policy))
+        hints = self.hint_cache[1]
+        return hints[min(hint_number, len(hints)) - 1]
 
     def get_answer(self):
-        return self.answer
+        return self.answer.replace('#', '')
+
+
+class ShardSupervisor:
+    """
+    Runs each shard of the bot in its own process and restarts shards that exit, backing off on repeated failures.
+    Shards are started at least start_interval seconds apart since Discord limits how fast shards may identify.
+    target(shard_id, shard_count), the clock and the process factory can be swapped out, so the restart logic runs
+    without a gateway connection.
+    """
+    def __init__(self, shard_count, target=None, start_interval=5, restart_delay=5, max_restart_delay=300,
+                 stable_after=60, clock=time.monotonic, process_factory=multiprocessing.Process):
+        self.shard_count = shard_count
+        self.target = target or run_shard
+        self.start_interval = start_interval
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stable_after = stable_after
+        self.clock = clock
+        self.process_factory = process_factory
+        self.processes = {}
+        self.started_at = {}
+        self.failures = {}
+        self.restart_at = {}
+        self.next_start = 0
+
+    def start(self, shard_id):
+        process = self.process_factory(target=self.target, args=(shard_id, self.shard_count),
+                                       name='shard-{}'.format(shard_id))
+        process.start()
+        self.processes[shard_id] = process
+        self.started_at[shard_id] = self.clock()
+
+    def check(self):
+        """
+        restarts dead shards once their back-off is over and starts at most one shard per start_interval.
+        :return: None
+        """
+        now = self.clock()
+        for shard_id in range(self.shard_count):
+            process = self.processes.get(shard_id)
+            if process is not None and process.is_alive():
+                if now - self.started_at[shard_id] >= self.stable_after:
+                    self.failures[shard_id] = 0
+                continue
+            if process is not None:
+                del self.processes[shard_id]
+                failures = self.failures.get(shard_id, 0) + 1
+                self.failures[shard_id] = failures
+                delay = min(self.max_restart_delay, self.restart_delay * 2 ** (failures - 1))
+                self.restart_at[shard_id] = now + delay
+                print('Shard {} exited with code {}, restarting in {}s.'.format(shard_id, process.exitcode, delay))
+            if now >= self.restart_at.get(shard_id, 0) and now >= self.next_start:
+                self.start(shard_id)
+                self.next_start = now + self.start_interval
+
+    def stop(self):
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join()
+        self.processes = {}
+
+    def run(self, interval=1):
+        try:
+            while True:
+                self.check()
+                time.sleep(interval)
+        finally:
+            self.stop()
+
+
+def create_bot(shard_id=None, shard_count=None):
+    """
+    builds the bot with every cog. shard_id and shard_count are passed on to discord.py when running sharded.
+    :return: commands.Bot
+    """
+    bot = commands.Bot(command_prefix='.', shard_id=shard_id, shard_count=shard_count)
+    bot.remove_command('help')
+    bot.add_cog(Music(bot))
+    bot.add_cog(TextCommands(bot))
+    trivia = Trivia(bot)
+    bot.add_cog(trivia)
+    bot.add_cog(Question)
+
+    @bot.event
+    async def on_ready():
+        print("Ready to use!")
+
+    @bot.event
+    async def on_message(message):
+        started = time.perf_counter()
+        metrics.inc('messages_total')
+        if not message.content.startswith(bot.command_prefix):
+            if not message.author.bot:
+                await trivia.answer_question(message)
+            metrics.observe('on_message_dispatch_seconds', time.perf_counter() - started)
+            await bot.process_commands(message)
+            return
+
+        name = message.content[len(bot.command_prefix):].split(' ', 1)[0]
+        await bot.process_commands(message)
+        if name in bot.commands:
+            metrics.observe('command_seconds', time.perf_counter() - started, ('command', name))
 
+    if c.METRICS_PORT:
+        bot.loop.create_task(metrics.serve('127.0.0.1', c.METRICS_PORT + (shard_id or 0)))
 
-bot = commands.Bot(command_prefix='.')
-bot.remove_command('help')
-bot.add_cog(Music(bot))
-bot.add_cog(TextCommands(bot))
-bot.add_cog(Trivia(bot))
-bot.add_cog(Question)
+    return bot
 
 
-@bot.event
-async def on_ready():
-    print("Ready to use!")
+def run_shard(shard_id=None, shard_count=None):
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt
 
+    # ShardSupervisor stops shards with SIGTERM; bot.run logs out cleanly on KeyboardInterrupt
+    signal.signal(signal.SIGTERM, interrupt)
+    bot = create_bot(shard_id, shard_count)
+    try:
+        bot.run(c.TOKEN)
+    finally:
+        bot.get_cog('Music').close()
+        bot.get_cog('Trivia').close()
 
-@bot.event
-async def on_message(message):
-    print(Trivia(bot).trivia_start())
-    await Trivia(bot).answer_question(message)
-    await bot.process_commands(message)
 
-bot.run(c.TOKEN)
+if __name__ == '__main__':
+    if c.SHARD_COUNT > 1:
+        # parse the question bank (and refresh its cache) once, forked shards inherit it instead of loading their own
+        QuestionBank.shared()
+        ShardSupervisor(c.SHARD_COUNT).run()
+    else:
+        run_shard()
@@ -0,0 +1,263 @@
+"""
+Offline tests for the parts of main.py that talk to Discord or manage processes. Nothing touches the network: Discord
+is a local fake HTTP endpoint and shards are fake processes on a fake clock.
+
+    python -m unittest test_main
+"""
+import asyncio
+import json
+import types
+import unittest
+
+import config as c
+
+c.MUSIC_CACHE = None
+c.AUDIO_CACHE = None
+c.TRIVIA_DB = None
+c.METRICS_PORT = None
+
+import discord
+import main
+
+
+class FakeDiscord:
+    """
+    A local HTTP endpoint standing in for Discord's create message route. It enforces a rate limit bucket of rate
+    requests per per seconds per channel, answering 429 once a bucket is empty, and fails the next fail requests
+    with a 500.
+    """
+    def __init__(self, loop, rate, per):
+        self.loop = loop
+        self.rate = rate
+        self.per = per
+        self.fail = 0
+        self.messages = []
+        self.statuses = []
+        self.buckets = {}
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def status(self, channel_id):
+        if self.fail:
+            self.fail -= 1
+            return 500
+        now = self.loop.time()
+        bucket = [sent for sent in self.buckets.get(channel_id, []) if sent > now - self.per]
+        if len(bucket) >= self.rate:
+            return 429
+        bucket.append(now)
+        self.buckets[channel_id] = bucket
+        return 200
+
+    async def handle(self, reader, writer):
+        request = await reader.readline()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode().partition(':')
+            headers[name.strip().lower()] = value.strip()
+        body = json.loads((await reader.readexactly(int(headers['content-length']))).decode())
+        channel_id = request.split()[1].decode().split('/')[3]
+        status = self.status(channel_id)
+        self.statuses.append(status)
+        if status == 200:
+            self.messages.append((channel_id, body))
+        writer.write('HTTP/1.0 {} X\r\nContent-Length: 2\r\n\r\n{{}}'.format(status).encode())
+        await writer.drain()
+        writer.close()
+
+
+class HTTPBot:
+    """
+    The bits of discord.Client that MessageBatcher uses, sending over HTTP to a FakeDiscord.
+    """
+    def __init__(self, loop, port):
+        self.loop = loop
+        self.port = port
+
+    async def send_message(self, destination, content=None, *, tts=False, embed=None):
+        body = json.dumps({'content': content, 'embed': embed.to_dict() if embed is not None else None}).encode()
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        writer.write('POST /api/channels/{}/messages HTTP/1.0\r\nContent-Type: application/json\r\n'
+                     'Content-Length: {}\r\n\r\n'.format(destination.id, len(body)).encode() + body)
+        status = int((await reader.readline()).split()[1])
+        writer.close()
+        if status != 200:
+            raise discord.HTTPException(types.SimpleNamespace(status=status, reason='fake'), 'fake')
+
+
+class MessageBatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.discord = FakeDiscord(self.loop, rate=3, per=0.25)
+        self.bot = HTTPBot(self.loop, self.loop.run_until_complete(self.discord.start()))
+        self.channel = types.SimpleNamespace(id='1', server=types.SimpleNamespace(id='10'))
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.discord.stop())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def batcher(self):
+        return main.MessageBatcher(self.bot, self.channel, window=0.01, rate=3, per=0.3)
+
+    def drain(self, batcher):
+        while batcher.pending or (batcher.task is not None and not batcher.task.done()):
+            self.loop.run_until_complete(asyncio.sleep(0.01))
+
+    def test_burst_is_coalesced(self):
+        batcher = self.batcher()
+        for number in range(6):
+            batcher.send('line {}'.format(number))
+        self.drain(batcher)
+        self.assertEqual(len(self.discord.messages), 1)
+        self.assertEqual(self.discord.messages[0][1]['content'], '\n'.join('line {}'.format(n) for n in range(6)))
+
+    def test_long_burst_is_split_at_the_limit(self):
+        batcher = self.batcher()
+        for _ in range(30):
+            batcher.send('x' * 199)
+        self.drain(batcher)
+        self.assertEqual([len(body['content']) for _, body in self.discord.messages], [1999, 1999, 1999])
+
+    def test_sends_stay_inside_the_bucket(self):
+        batcher = self.batcher()
+        for number in range(8):
+            batcher.send(embed=discord.Embed(title=str(number)))
+        self.drain(batcher)
+        self.assertEqual(len(self.discord.messages), 8)
+        self.assertNotIn(429, self.discord.statuses)
+
+    def test_failed_send_is_counted_and_the_queue_keeps_going(self):
+        errors = main.metrics.counters.get(('send_errors_total', (('error', 'HTTPException'),)), 0)
+        self.discord.fail = 1
+        batcher = self.batcher()
+        batcher.send(embed=discord.Embed(title='lost'))
+        batcher.send('still sent')
+        self.drain(batcher)
+        self.assertEqual([body['content'] for _, body in self.discord.messages], ['still sent'])
+        self.assertEqual(main.metrics.counters[('send_errors_total', (('error', 'HTTPException'),))], errors + 1)
+
+    def test_scoreboard_is_one_embed(self):
+        session = main.TriviaSession(self.bot, self.channel, [], None)
+        for number in range(30):
+            session.scores[str(number)] = number
+            session.names[str(number)] = 'player{}'.format(number)
+        session.print_scores()
+        self.drain(session.outbox)
+        self.assertEqual(len(self.discord.messages), 1)
+        embed = self.discord.messages[0][1]['embed']
+        self.assertEqual(len(embed['fields']), 25)
+        self.assertIn('player29', embed['description'])
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeProcess:
+    def __init__(self, target, args, name):
+        self.target = target
+        self.args = args
+        self.name = name
+        self.alive = False
+        self.exitcode = None
+        self.joined = False
+
+    def start(self):
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+    def crash(self, code=1):
+        self.alive = False
+        self.exitcode = code
+
+    def terminate(self):
+        self.crash(-15)
+
+    def join(self):
+        self.joined = True
+
+
+class ShardSupervisorTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.started = []
+        self.supervisor = main.ShardSupervisor(3, target=print, start_interval=5, restart_delay=5,
+                                               max_restart_delay=20, stable_after=60, clock=self.clock,
+                                               process_factory=self.process)
+
+    def process(self, target, args, name):
+        process = FakeProcess(target, args, name)
+        self.started.append(process)
+        return process
+
+    def advance(self, seconds):
+        self.clock.now += seconds
+        self.supervisor.check()
+
+    def test_shards_start_one_per_interval(self):
+        self.supervisor.check()
+        self.assertEqual([process.args for process in self.started], [(0, 3)])
+        self.advance(4)
+        self.assertEqual(len(self.started), 1)
+        self.advance(1)
+        self.advance(5)
+        self.assertEqual([process.args for process in self.started], [(0, 3), (1, 3), (2, 3)])
+        self.assertEqual([process.name for process in self.started], ['shard-0', 'shard-1', 'shard-2'])
+
+    def test_crashed_shard_restarts_with_back_off(self):
+        for _ in range(3):
+            self.advance(5)
+        shard = self.supervisor.processes[1]
+        delays = []
+        for _ in range(4):
+            shard.crash()
+            self.advance(0)
+            crashed_at = self.clock.now
+            while self.supervisor.processes.get(1) is None:
+                self.advance(1)
+            delays.append(self.clock.now - crashed_at)
+            shard = self.supervisor.processes[1]
+        self.assertEqual(delays, [5, 10, 20, 20])
+        self.assertEqual(len(self.started), 7)
+
+    def test_failures_reset_once_a_shard_is_stable(self):
+        for _ in range(3):
+            self.advance(5)
+        self.supervisor.processes[0].crash()
+        self.advance(0)
+        self.advance(5)
+        self.assertEqual(self.supervisor.failures[0], 1)
+        self.advance(60)
+        self.assertEqual(self.supervisor.failures[0], 0)
+        self.supervisor.processes[0].crash()
+        self.advance(0)
+        self.assertEqual(self.supervisor.restart_at[0], self.clock.now + 5)
+
+    def test_stop_terminates_every_shard(self):
+        for _ in range(3):
+            self.advance(5)
+        self.supervisor.stop()
+        self.assertEqual(self.supervisor.processes, {})
+        self.assertTrue(all(process.exitcode == -15 and process.joined for process in self.started))
+
+
+if __name__ == '__main__':
+    unittest.main()